@@ -0,0 +1,27 @@
+"""
+Micro-benchmark: formatting and parsing amounts, against the reference
+implementations of tests/reference.py. Run as: python bench/amounts.py
+"""
+
+import os
+import random
+import sys
+import timeit
+
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(here,".."))
+sys.path.insert(0,os.path.join(here,"..","tests"))
+import debs
+import reference
+
+def main():
+    rnd=random.Random(10)
+    values=[rnd.randrange(-10**rnd.randrange(1,16),10**rnd.randrange(1,16)) for _ in range(10000)]
+    strings=[reference.int2cur(v).replace("&minus;","-") for v in values]
+    for name,f,args in (("int2cur",debs.int2cur,values),("ref int2cur",reference.int2cur,values),
+    ("cur2int",debs.cur2int,strings),("ref cur2int",reference.cur2int,strings)):
+        t=min(timeit.repeat(lambda: [f(a) for a in args],number=5,repeat=5))/5/len(args)
+        print("{:12} {:7.0f} ns".format(name,t*1e9))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Load test: throughput of a shared database against the number of worker processes
+
+Each worker process calls the WSGI application directly, as a server
+process would, with a share of the requests; one request in WRITE_EVERY
+inserts a transaction, the others read an account page or the list of
+accounts. The database is a copy of the empty debs.sql in a temporary
+directory. Run as: python bench/load.py [requests] [workers...]
+"""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import multiprocessing as mp
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import debs
+
+WRITE_EVERY=10
+
+def request(path,qs="",post=None):
+    """call the application, return the status"""
+    environ={"PATH_INFO":path,"QUERY_STRING":qs,"REQUEST_METHOD":"GET" if post is None else "POST",
+    "wsgi.input":io.BytesIO((post or "").encode()),"wsgi.errors":sys.stderr}
+    status=[]
+    b"".join(debs.application(environ,lambda s,h: status.append(s)))
+    return status[0]
+
+def worker(args):
+    """serve n requests, return the number of failed ones"""
+    n,w=args
+    errors=0
+    for i in range(n):
+        if i%WRITE_EVERY==0:
+            s=request("/ins_xact",post="yyyy={}&mm={}&dd={}&dr=1,00&cr=&newbal=&aid=2&oaid=1&comment=w{}".format(
+            *time.strftime("%Y %m %d").split(),w))
+        elif i%2:
+            s=request("/acct","aid=2")
+        else:
+            s=request("/")
+        if s[0] not in "23":
+            errors+=1
+    return errors
+
+def setup(db):
+    """create the accounts of the test"""
+    shutil.copy(os.path.join(os.path.dirname(debs.__file__),"debs.sql"),db)
+    os.environ["DB"]=db
+    for atype,name in (("E","Capital"),("A","Cash")):
+        request("/creat_acct",post="atype={}&aname={}".format(atype,name))
+    debs.pool_evict(db)
+
+def main(argv):
+    total=int(argv[0]) if argv else 4000
+    workers=[int(w) for w in argv[1:]] or [1,2,4,8]
+    with tempfile.TemporaryDirectory() as d:
+        db=os.path.join(d,"load.sql")
+        setup(db)
+        for w in workers:
+            t=time.perf_counter()
+            with mp.get_context("fork").Pool(w) as p:
+                errors=sum(p.map(worker,[(total//w,i) for i in range(w)]))
+            t=time.perf_counter()-t
+            print("{} workers: {:.0f} requests/s, {} failed".format(w,total/t,errors))
+        cnx=debs.connect(db,None)
+        print(list(debs.audit(cnx.cursor()))[-1],end="")
+        cnx.close()
+
+if __name__=="__main__":
+    main(sys.argv[1:])
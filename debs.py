@@ -4,20 +4,48 @@ Copyright (c) 2022 Alexander Mukhin
 MIT License
 """
 
-from collections import namedtuple
-from urllib.parse import parse_qs
+from collections import namedtuple,OrderedDict
+from functools import partial
+from itertools import chain,groupby
+from math import ceil
+from urllib.parse import parse_qs,urlencode
 from datetime import date
-from html import escape
+from html import escape,unescape
+from array import array
+from http.cookies import SimpleCookie,CookieError
+from concurrent.futures import ThreadPoolExecutor
 import os
+import sys
+import argparse
+import threading
+import csv
+import json
+import io
+import hashlib
+import random
+import secrets
+import time
+import asyncio
 try:
     from pysqlcipher3 import dbapi2 as sqlite3
 except ImportError:
     import sqlite3
-from math import ceil
 
 THOUSAND_SEP=" "
 DECIMAL_SEP=","
 LIMIT=100
+IMPORT_BATCH=10000
+STREAM_CHUNK=16384
+# rows fetched at once by exports
+EXPORT_BATCH=10000
+# export formats: content type and file extension
+EXPORTS={"csv":("text/csv","csv"),"json":("application/x-ndjson","ndjson"),
+"columns":("application/octet-stream","col")}
+# fields of exported transactions
+EXPORT_FIELDS=["xid","date","aid","oaid","dr","cr","bal","comment"]
+# leading bytes of a columnar export
+COLUMNS_MAGIC=b"DEBSCOL1"
+AUDIT_INTERVAL=3600
 ATYPES=[("E","Equity"),("A","Assets"),("L","Liabilities"),("i","Income"),("e","Expenses")]
 STYLE="""
 body { background-color: #fff1e5; }
@@ -46,8 +74,137 @@ tr.sep_month td { border-top: 2px solid #b0b0b0; }
 tr.sep_year td { border-top: 2px solid #808080; }
 tr.sep_tot td { border-top: 2px solid #b0b0b0; }
 """
+# validator of the style sheet
+STYLE_ETAG='"{}"'.format(hashlib.sha1(STYLE.encode()).hexdigest()[:16])
+# validator component of the pages, changing with the program
+with open(__file__,"rb") as f:
+    PAGES_ETAG=hashlib.sha1(f.read()).hexdigest()[:8]
+# pages answered with 304 Not Modified while the database is unchanged
+CACHED={"/","/acct","/trial_bal","/income_stmt","/monthly","/search"}
+# pages kept rendered in memory, and how many of them, set by the
+# DEBS_PAGE_CACHE environment variable (0 disables the cache)
+PAGE_ROUTES={"/","/acct"}
+PAGE_CACHE_SIZE=int(os.environ.get("DEBS_PAGE_CACHE",256))
+# request and query instrumentation, enabled by the DEBS_INSTRUMENT environment
+# variable; statements slower than DEBS_SLOW_QUERY seconds are logged with their plans
+INSTRUMENT="DEBS_INSTRUMENT" in os.environ
+SLOW_QUERY=float(os.environ.get("DEBS_SLOW_QUERY",0.1))
+# distinct routes counted in metrics, the rest are counted as "other"
+METRICS_ROUTES=50
+# settings applied to every new database connection
+PRAGMAS=[("journal_mode","WAL"),("cache_size",-16384),("mmap_size",268435456)]
+# idle connections kept per database and key
+POOL_SIZE=4
+# seconds a statement waits on a locked database, and the number of
+# further attempts to start a write transaction before giving up
+BUSY_TIMEOUT=0.5
+BUSY_RETRIES=8
+# sessions: cookie name and seconds of inactivity before a session and
+# its keyed connections are dropped
+SESSION_COOKIE="debs_session"
+SESSION_TTL=1800
+# routes writing to the database; their transactions take the write lock upfront
+WRITES={"/ins_xact","/del_xact","/creat_acct","/close_acct","/import","/restore"}
+# ASGI: threads running reads; writes run on a thread of their own, so
+# that together there is one pooled connection per thread
+ASGI_READERS=POOL_SIZE-1
+# backups: pages copied per step, seconds paused between steps so that
+# requests are served meanwhile, and the directory of the backups made
+# through the web interface, set by the DEBS_BACKUP_DIR environment
+# variable (default: the directory of the database)
+BACKUP_PAGES=1024
+BACKUP_PAUSE=0.01
+BACKUP_DIR=os.environ.get("DEBS_BACKUP_DIR")
+# archive of closed periods: suffix of its file beside the database, and
+# the comment of the rows opening the accounts at the start of the open period
+ARCHIVE_SUFFIX=".archive"
+OPENING_COMMENT="Opening balance"
+# an amount stored as text, converted to a native integer unless it overflows
+AMOUNT="CASE WHEN CAST({0} AS INTEGER)||''={0} THEN CAST({0} AS INTEGER) ELSE {0} END"
+# schema migrations, applied in order at startup, each a list of statements
+# or functions of a cursor; the database's user_version counts the migrations
+# already applied
+MIGRATIONS=[
+    # 1: per-account indexes on transactions
+    [
+        "CREATE INDEX IF NOT EXISTS xacts_aid_xid ON xacts(aid,xid DESC,bal)",
+        "CREATE INDEX IF NOT EXISTS xacts_aid_dt ON xacts(aid,dt)",
+    ],
+    # 2: materialized balances, the last transaction of each account
+    [
+        "CREATE TABLE acct_bals (aid integer primary key, xid integer not null, bal text not null)",
+        "INSERT INTO acct_bals SELECT aid,MAX(xid),bal FROM xacts GROUP BY aid",
+    ],
+    # 3: amounts as native integers; the amount columns are left without
+    # a type, so that amounts overflowing 64 bits are kept as exact text
+    [
+        """CREATE TABLE xacts_new (xid integer not null, dt int not null, aid integer not null,
+        oaid integer not null, dr not null, cr not null, bal not null, comment text, unique (xid, aid))""",
+        "INSERT INTO xacts_new SELECT xid,dt,aid,oaid,{},{},{},comment FROM xacts".format(
+        AMOUNT.format("dr"),AMOUNT.format("cr"),AMOUNT.format("bal")),
+        "DROP TABLE xacts",
+        "ALTER TABLE xacts_new RENAME TO xacts",
+        "CREATE INDEX xacts_aid_xid ON xacts(aid,xid DESC,bal)",
+        "CREATE INDEX xacts_aid_dt ON xacts(aid,dt)",
+        "CREATE TABLE acct_bals_new (aid integer primary key, xid integer not null, bal not null)",
+        "INSERT INTO acct_bals_new SELECT aid,xid,{} FROM acct_bals".format(AMOUNT.format("bal")),
+        "DROP TABLE acct_bals",
+        "ALTER TABLE acct_bals_new RENAME TO acct_bals",
+    ],
+    # 4: balances as of a date, seeking on (aid,dt,xid)
+    [
+        "DROP INDEX xacts_aid_dt",
+        "CREATE INDEX xacts_aid_dt_xid ON xacts(aid,dt,xid,bal)",
+    ],
+    # 5: total balances by account type, kept in step with acct_bals
+    [
+        "CREATE TABLE type_totals (type text primary key, total not null)",
+        lambda crs: rebuild_totals(crs),
+    ],
+    # 6: sequence of transaction ids, allocated without scanning xacts
+    [
+        "CREATE TABLE seqs (name text primary key, val integer not null)",
+        "INSERT INTO seqs SELECT 'xid',COALESCE(MAX(xid)+1,0) FROM xacts",
+    ],
+    # 7: a version counting the changes that do not allocate transaction ids;
+    # together with the xid sequence it marks every change of the database
+    [
+        "INSERT INTO seqs VALUES('version',0)",
+    ]+[
+        """CREATE TRIGGER {0}_{1} AFTER {1} ON {0}
+        BEGIN UPDATE seqs SET val=val+1 WHERE name='version'; END""".format(table,op)
+        for table,op in (("accts","insert"),("accts","update"),("accts","delete"),
+        ("xacts","update"),("xacts","delete"))
+    ],
+    # 8: full-text index of comments; see create_search()
+    [
+        lambda crs: create_search(crs),
+    ],
+    # 9: a version of the accounts alone, for the account directory
+    [
+        "INSERT INTO seqs VALUES('accts',0)",
+    ]+[
+        """CREATE TRIGGER accts_dir_{0} AFTER {0} ON accts
+        BEGIN UPDATE seqs SET val=val+1 WHERE name='accts'; END""".format(op)
+        for op in ("insert","update","delete")
+    ],
+    # 10: the first day of the open period; earlier transactions are archived
+    [
+        "CREATE TABLE period (closed int not null)",
+        "INSERT INTO period VALUES(0)",
+    ],
+    # 11: the running balances are ordered by (dt,xid), which xacts_aid_dt_xid serves
+    [
+        "DROP INDEX xacts_aid_xid",
+    ],
+    # 12: index comments as typed rather than escaped
+    [
+        lambda crs: create_search(crs),
+    ],
+]
 
-# a named tuple for storing HTML response components
+# a named tuple for storing HTML response components;
+# the body is a string, or an iterable of strings streamed to the client
 HTMLResponse=namedtuple("HTMLResponse",["status","headers","body"])
 
 class BadInput(Exception):
@@ -55,9 +212,11 @@ class BadInput(Exception):
 
 def application(environ,start_response):
     """entry point"""
+    start=time.perf_counter()
+    cnx=None
+    crs=None
     try:
-        # connect to the database
-        cnx=None
+        # find the database
         if "DB" in os.environ:
             # try OS environment
             db=os.environ["DB"]
@@ -68,38 +227,52 @@ def application(environ,start_response):
             raise sqlite3.Error("No file given")
         if not os.path.exists(db):
             raise sqlite3.Error("File does not exist")
-        cnx=sqlite3.connect(db)
-        cnx.isolation_level=None # we manage transactions explicitly
-        crs=cnx.cursor()
-        crs.execute("BEGIN") # execute each request in a transaction
         # main selector
         p=environ["PATH_INFO"]
         qs=environ.get("QUERY_STRING")
-        with cnx:
-            if p=="/ask_dbkey":
-                r=ask_dbkey()
-            elif p=="/set_dbkey":
-                application.dbkey=get_dbkey(environ)
-                r=HTMLResponse("303 See Other",[("Location",".")],"")
-            elif p=="/clr_dbkey":
-                application.dbkey=None
-                r=HTMLResponse("303 See Other",[("Location","ask_dbkey")],"")
-            elif not valid_dbkey(crs,application.dbkey):
+        if p=="/ask_dbkey":
+            r=ask_dbkey()
+        elif p=="/style.css":
+            r=style(environ)
+        elif p=="/metrics" and INSTRUMENT:
+            r=metrics()
+        elif p=="/set_dbkey":
+            key=get_dbkey(environ)
+            session_end(environ)
+            sid=session_new(db,key)
+            r=HTMLResponse("303 See Other",[("Location","."),session_cookie(environ,sid)],"")
+        elif p=="/clr_dbkey":
+            session_end(environ)
+            r=HTMLResponse("303 See Other",[("Location","ask_dbkey"),session_cookie(environ,None)],"")
+        else:
+            key=session_key(environ,db)
+            environ["debs.dbkey"]=key
+            cnx=pool_get(db,key)
+            if cnx is None:
                 r=HTMLResponse("303 See Other",[("Location","ask_dbkey")],"")
-            elif p=="/":
-                r=main(crs)
-            elif p=="/acct":
-                r=acct(crs,qs)
-            elif p=="/ins_xact":
-                r=ins_xact(crs,environ)
-            elif p=="/del_xact":
-                r=del_xact(crs,environ)
-            elif p=="/creat_acct":
-                r=creat_acct(crs,environ)
-            elif p=="/close_acct":
-                r=close_acct(crs,environ)
             else:
-                raise ValueError("Wrong access")
+                crs=cnx.cursor(TimedCursor) if INSTRUMENT else cnx.cursor()
+                begin(crs,p in WRITES) # execute each request in a transaction
+                mark=db_mark(crs) if p in CACHED or p in WRITES else None
+                tag=page_etag(mark,environ) if p in CACHED else None
+                if tag is not None and etag_matches(environ,tag):
+                    # answer before rendering anything
+                    r=HTMLResponse("304 Not Modified",[("ETag",tag)],"")
+                else:
+                    ckey=(db,key is not None,date.today().toordinal(),p,qs or "")
+                    r=page_get(ckey,mark) if p in PAGE_ROUTES else None
+                    if r is None:
+                        r=dispatch(crs,p,qs,environ)
+                        if p in PAGE_ROUTES and r.status.startswith("200"):
+                            r=page_put(ckey,mark,r)
+                    if tag is not None and r.status.startswith("200"):
+                        r.headers.append(("ETag",tag))
+                written=db_mark(crs) if p in WRITES else None
+                # a streamed body commits when it is complete
+                if isinstance(r.body,str):
+                    cnx.commit()
+                    if written is not None:
+                        pages_written(db,mark,written,environ.get("debs.stale"))
     except sqlite3.Error as e:
         r=HTMLResponse("500 Internal Server Error",[("Content-type","text/plain")],"Database error: {}".format(e))
     except ValueError as e:
@@ -108,17 +281,290 @@ def application(environ,start_response):
         r=HTMLResponse("400 Bad Request",[("Content-type","text/plain")],"Parameter expected: {}".format(e))
     except BadInput as e:
         r=HTMLResponse("400 Bad Request",[("Content-type","text/plain")],"Error: {}".format(e))
-    if cnx:
-        cnx.close()
-    start_response(r.status,r.headers+[("Cache-Control","max-age=0")])
-    return [r.body.encode()]
+    if not any(h=="Cache-Control" for h,_ in r.headers):
+        r.headers.append(("Cache-Control","max-age=0"))
+    if INSTRUMENT:
+        r=instrument(r,environ,start,crs)
+    start_response(r.status,r.headers)
+    if isinstance(r.body,str):
+        if cnx:
+            pool_put(db,key,cnx)
+        return [r.body.encode()]
+    return stream(r.body,db,key,cnx)
 
-# database key
-application.dbkey=None
+def stream(body,db,key,cnx):
+    """encode a streamed body of strings or bytes in chunks of about STREAM_CHUNK
+    bytes, then commit the request transaction and release the connection"""
+    try:
+        buf=[]
+        size=0
+        for s in body:
+            if isinstance(s,str):
+                s=s.encode()
+            buf.append(s)
+            size+=len(s)
+            if size>=STREAM_CHUNK:
+                yield b"".join(buf)
+                buf=[]
+                size=0
+        yield b"".join(buf)
+        if cnx:
+            cnx.commit()
+    finally:
+        if cnx:
+            pool_put(db,key,cnx)
 
-def ask_dbkey():
-    """ask for a database key"""
-    b="""
+# ASGI worker threads: reads run concurrently, writes one at a time
+READERS=ThreadPoolExecutor(ASGI_READERS,thread_name_prefix="debs-read")
+WRITER=ThreadPoolExecutor(1,thread_name_prefix="debs-write")
+
+async def asgi(scope,receive,send):
+    """ASGI entry point: run the WSGI application on the worker threads"""
+    if scope["type"]=="lifespan":
+        while True:
+            m=await receive()
+            if m["type"]=="lifespan.startup":
+                await send({"type":"lifespan.startup.complete"})
+            elif m["type"]=="lifespan.shutdown":
+                await send({"type":"lifespan.shutdown.complete"})
+                return
+    if scope["type"]!="http":
+        raise ValueError("Unsupported scope: {}".format(scope["type"]))
+    # read the request body
+    body=[]
+    more=True
+    while more:
+        m=await receive()
+        if m["type"]=="http.disconnect":
+            return
+        body.append(m.get("body",b""))
+        more=m.get("more_body",False)
+    environ=asgi_environ(scope,b"".join(body))
+    pool=WRITER if environ["PATH_INFO"] in WRITES else READERS
+    loop=asyncio.get_running_loop()
+    started=[]
+    def start_response(status,headers):
+        started.append((status,headers))
+    chunks=await loop.run_in_executor(pool,application,environ,start_response)
+    try:
+        status,headers=started[0]
+        await send({"type":"http.response.start","status":int(status.split()[0]),
+        "headers":[(h.lower().encode("latin-1"),v.encode("latin-1")) for h,v in headers]})
+        # a streamed body reads from the database, so it is advanced on the same threads
+        it=iter(chunks)
+        while True:
+            chunk=await loop.run_in_executor(pool,next,it,None)
+            if chunk is None:
+                break
+            await send({"type":"http.response.body","body":chunk,"more_body":True})
+        await send({"type":"http.response.body","body":b""})
+    finally:
+        # release the connection of a stream left unfinished
+        if hasattr(chunks,"close"):
+            await loop.run_in_executor(pool,chunks.close)
+
+def asgi_environ(scope,body):
+    """make a WSGI environment of an ASGI HTTP scope and a request body"""
+    server=scope.get("server") or ("localhost",80)
+    root=scope.get("root_path","")
+    environ={
+        "REQUEST_METHOD":scope["method"],
+        "SCRIPT_NAME":root,
+        "PATH_INFO":scope["path"][len(root):] if scope["path"].startswith(root) else scope["path"],
+        "QUERY_STRING":scope.get("query_string",b"").decode("latin-1"),
+        "SERVER_NAME":server[0],
+        "SERVER_PORT":str(server[1]),
+        "SERVER_PROTOCOL":"HTTP/{}".format(scope.get("http_version","1.1")),
+        "CONTENT_LENGTH":str(len(body)),
+        "wsgi.version":(1,0),
+        "wsgi.url_scheme":scope.get("scheme","http"),
+        "wsgi.input":io.BytesIO(body),
+        "wsgi.errors":sys.stderr,
+        "wsgi.multithread":True,
+        "wsgi.multiprocess":False,
+        "wsgi.run_once":False,
+    }
+    # join repeated headers, cookies as in a single Cookie header
+    for h,v in scope.get("headers",[]):
+        h=h.decode("latin-1").upper().replace("-","_")
+        v=v.decode("latin-1")
+        if h=="CONTENT_TYPE":
+            environ[h]=v
+        elif h!="CONTENT_LENGTH":
+            h="HTTP_"+h
+            environ[h]=environ[h]+("; " if h=="HTTP_COOKIE" else ",")+v if h in environ else v
+    return environ
+
+class TimedCursor(sqlite3.Cursor):
+    """a cursor counting and timing its statements, and keeping the slow ones"""
+
+    def __init__(self,*args):
+        super().__init__(*args)
+        self.queries=0
+        self.seconds=0.0
+        self.slow=[]
+
+    def timed(self,f,sql,params):
+        """run a statement through f, account for it"""
+        t=time.perf_counter()
+        try:
+            return f(sql,params)
+        finally:
+            t=time.perf_counter()-t
+            self.queries+=1
+            self.seconds+=t
+            if t>=SLOW_QUERY and not sql.lstrip().upper().startswith(("BEGIN","PRAGMA")):
+                try:
+                    plan=self.connection.execute("EXPLAIN QUERY PLAN "+sql,
+                    params if f==super().execute else []).fetchall()
+                except sqlite3.Error:
+                    plan=[]
+                self.slow.append((t," ".join(sql.split()),[row[-1] for row in plan]))
+
+    def execute(self,sql,params=()):
+        return self.timed(super().execute,sql,params)
+
+    def executemany(self,sql,params):
+        return self.timed(super().executemany,sql,params)
+
+    def fetchone(self):
+        t=time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.seconds+=time.perf_counter()-t
+
+    def fetchmany(self,size=None):
+        t=time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self.seconds+=time.perf_counter()-t
+
+    def fetchall(self):
+        t=time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.seconds+=time.perf_counter()-t
+
+    def __next__(self):
+        t=time.perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            self.seconds+=time.perf_counter()-t
+
+# per-route counters: requests, seconds, queries, query seconds, slow queries
+METRICS={}
+METRICS_LOCK=threading.Lock()
+
+def instrument(r,environ,start,crs):
+    """add timing headers to a response, record its metrics when it is complete"""
+    elapsed=time.perf_counter()-start
+    # a streamed body, and its statements, run after the headers are sent:
+    # only the time until then is known, the rest goes to the metrics
+    if not isinstance(r.body,str):
+        timing=['app;dur={:.1f};desc="before the body"'.format(elapsed*1000)]
+    else:
+        timing=["app;dur={:.1f}".format(elapsed*1000)]
+        if crs is not None:
+            timing.append('db;dur={:.1f};desc="{} queries"'.format(crs.seconds*1000,crs.queries))
+    r.headers.append(("Server-Timing",", ".join(timing)))
+    route=environ.get("PATH_INFO","")
+    if isinstance(r.body,str):
+        record(environ,route,elapsed,crs)
+        return r
+    return r._replace(body=recorded(r.body,environ,route,start,crs))
+
+def recorded(body,environ,route,start,crs):
+    """pass a streamed body through, record its metrics when it is complete"""
+    try:
+        yield from body
+    finally:
+        record(environ,route,time.perf_counter()-start,crs)
+
+def record(environ,route,seconds,crs):
+    """account for a request, log its slow statements"""
+    queries,qseconds,slow=(crs.queries,crs.seconds,crs.slow) if crs is not None else (0,0.0,[])
+    for t,sql,plan in slow:
+        environ.get("wsgi.errors",sys.stderr).write("slow query ({:.3f} s) on {}: {} [{}]\n".format(t,route,sql,"; ".join(plan)))
+    with METRICS_LOCK:
+        if route not in METRICS and len(METRICS)>=METRICS_ROUTES:
+            route="other"
+        m=METRICS.setdefault(route,[0,0.0,0,0.0,0])
+        m[0]+=1
+        m[1]+=seconds
+        m[2]+=queries
+        m[3]+=qseconds
+        m[4]+=len(slow)
+
+def metrics():
+    """show request and query metrics in Prometheus text format"""
+    with METRICS_LOCK:
+        items=sorted((route,list(m)) for route,m in METRICS.items())
+    b=[]
+    for i,(name,kind,text) in enumerate((
+    ("debs_requests_total","counter","Requests served."),
+    ("debs_request_seconds_total","counter","Time spent serving requests."),
+    ("debs_queries_total","counter","SQL statements executed."),
+    ("debs_query_seconds_total","counter","Time spent in SQL statements."),
+    ("debs_slow_queries_total","counter","SQL statements slower than DEBS_SLOW_QUERY."))):
+        b.append("# HELP {} {}\n# TYPE {} {}\n".format(name,text,name,kind))
+        for route,m in items:
+            b.append('{}{{route="{}"}} {}\n'.format(name,route.replace("\\","\\\\").replace('"','\\"'),m[i]))
+    with PAGES_LOCK:
+        stats=dict(PAGE_STATS,pages=len(PAGES))
+    b.append("# HELP debs_page_cache_hits_total Pages served from the page cache.\n"
+    "# TYPE debs_page_cache_hits_total counter\n"
+    "debs_page_cache_hits_total {hits}\n"
+    "# HELP debs_page_cache_misses_total Cacheable pages rendered.\n"
+    "# TYPE debs_page_cache_misses_total counter\n"
+    "debs_page_cache_misses_total {misses}\n"
+    "# HELP debs_page_cache_pages Pages in the page cache.\n"
+    "# TYPE debs_page_cache_pages gauge\n"
+    "debs_page_cache_pages {pages}\n".format(**stats))
+    return HTMLResponse("200 OK",[("Content-type","text/plain; version=0.0.4")],"".join(b))
+
+def dispatch(crs,p,qs,environ):
+    """select the handler for a request on a keyed database"""
+    if p=="/":
+        return main(crs,environ)
+    if p=="/acct":
+        return acct(crs,qs)
+    if p=="/ins_xact":
+        return ins_xact(crs,environ)
+    if p=="/del_xact":
+        return del_xact(crs,environ)
+    if p=="/creat_acct":
+        return creat_acct(crs,environ)
+    if p=="/close_acct":
+        return close_acct(crs,environ)
+    if p=="/import":
+        return bulk_import(crs,environ)
+    if p=="/trial_bal":
+        return trial_bal(crs,qs)
+    if p=="/income_stmt":
+        return income_stmt(crs,qs)
+    if p=="/monthly":
+        return monthly(crs,qs)
+    if p=="/audit":
+        return audit_page(crs)
+    if p=="/search":
+        return search(crs,qs)
+    if p=="/export":
+        return export(crs,qs)
+    if p=="/backup":
+        return backup_page(crs,environ)
+    if p=="/restore":
+        return restore_page(crs,environ)
+    raise ValueError("Wrong access")
+
+def fragment(s):
+    """precompile a page fragment: drop the source indentation"""
+    return "".join(line.strip()+"\n" for line in s.strip().split("\n"))
+
+ASK_DBKEY=fragment("""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -131,9 +577,108 @@ def ask_dbkey():
     </form>
     </body>
     </html>
-    """
+    """)
+
+def ask_dbkey():
+    """ask for a database key"""
     # return success
-    return HTMLResponse("200 OK",[("Content-type","text/html")],b)
+    return HTMLResponse("200 OK",[("Content-type","text/html")],ASK_DBKEY)
+
+def style(environ):
+    """serve the style sheet, revalidated by its ETag"""
+    headers=[("ETag",STYLE_ETAG),("Cache-Control","max-age=3600")]
+    if etag_matches(environ,STYLE_ETAG):
+        return HTMLResponse("304 Not Modified",headers,"")
+    return HTMLResponse("200 OK",[("Content-type","text/css")]+headers,STYLE)
+
+def etag_matches(environ,tag):
+    """tell whether the If-None-Match header of a request names an ETag"""
+    tags=[t.strip() for t in environ.get("HTTP_IF_NONE_MATCH","").split(",")]
+    return "*" in tags or any(t==tag or t=="W/"+tag for t in tags)
+
+def db_mark(crs):
+    """get the change marker of the database: the xid sequence and the version"""
+    crs.execute("SELECT (SELECT val FROM seqs WHERE name='xid'),(SELECT val FROM seqs WHERE name='version')")
+    return crs.fetchone()
+
+def page_etag(mark,environ):
+    """make the ETag of a page from the change marker of the database,
+    the current date, the program, and whether the session is keyed"""
+    return '"{}.{}.{}.{}.{}"'.format(PAGES_ETAG,date.today().toordinal(),mark[0],mark[1],
+    int(environ.get("debs.dbkey") is not None))
+
+# rendered pages by (database,keyed session,date,route,query string), least
+# recently used first, as (aid,headers,body); the pages of a database are
+# consistent with the change marker it has in PAGE_MARKS
+PAGES=OrderedDict()
+PAGE_MARKS={}
+PAGE_STATS={"hits":0,"misses":0}
+PAGES_LOCK=threading.Lock()
+
+def page_get(ckey,mark):
+    """get a rendered page, None if it has to be rendered; a database changed
+    by another process or connection since the pages were rendered drops them"""
+    db=ckey[0]
+    with PAGES_LOCK:
+        last=PAGE_MARKS.get(db)
+        if mark!=last and (last is None or mark[0]>=last[0] and mark[1]>=last[1]):
+            pages_drop(db,lambda aid: True)
+            PAGE_MARKS[db]=mark
+        page=PAGES.get(ckey) if mark==PAGE_MARKS[db] else None
+        if page is None:
+            PAGE_STATS["misses"]+=1
+            return None
+        PAGES.move_to_end(ckey)
+        PAGE_STATS["hits"]+=1
+    return HTMLResponse("200 OK",list(page[1]),page[2])
+
+def page_put(ckey,mark,r):
+    """keep a rendered page; a streamed body is kept once it is sent whole,
+    and is passed on as it is rendered"""
+    if PAGE_CACHE_SIZE<=0:
+        return r
+    if isinstance(r.body,str):
+        page_keep(ckey,mark,tuple(r.headers),r.body)
+        return r
+    return r._replace(body=page_tee(ckey,mark,tuple(r.headers),r.body))
+
+def page_tee(ckey,mark,headers,body):
+    """pass the pieces of a streamed body on, keep the page at its end"""
+    b=[]
+    for s in body:
+        b.append(s)
+        yield s
+    page_keep(ckey,mark,headers,"".join(b))
+
+def page_keep(ckey,mark,headers,body):
+    """keep a page rendered at a mark of the database"""
+    try:
+        aid=int(parse_qs(ckey[4])["aid"][0])
+    except (KeyError,ValueError):
+        aid=None
+    with PAGES_LOCK:
+        # a page rendered from an older snapshot is not kept
+        if PAGE_MARKS.get(ckey[0])==mark:
+            PAGES[ckey]=(aid,headers,body)
+            PAGES.move_to_end(ckey)
+            while len(PAGES)>PAGE_CACHE_SIZE:
+                PAGES.popitem(last=False)
+
+def pages_written(db,before,after,stale):
+    """drop the pages changed by a write: the list of accounts and the pages of
+    the stale accounts, or every page if they are unknown or the pages were
+    not consistent with the database before the write"""
+    with PAGES_LOCK:
+        if stale is None or PAGE_MARKS.get(db)!=before:
+            pages_drop(db,lambda aid: True)
+        else:
+            pages_drop(db,lambda aid: aid is None or aid in stale)
+        PAGE_MARKS[db]=after
+
+def pages_drop(db,pred):
+    """drop the pages of a database whose account satisfies pred; hold PAGES_LOCK"""
+    for k in [k for k,page in PAGES.items() if k[0]==db and pred(page[0])]:
+        del PAGES[k]
 
 def get_dbkey(environ):
     """get a database key submitted in a POST query"""
@@ -156,29 +701,202 @@ def valid_dbkey(crs,key):
         return False
     return True
 
+def connect(db,key):
+    """open a database, return None if the key does not fit"""
+    cnx=sqlite3.connect(db,timeout=BUSY_TIMEOUT,check_same_thread=False)
+    cnx.isolation_level=None # we manage transactions explicitly
+    crs=cnx.cursor()
+    if not valid_dbkey(crs,key):
+        cnx.close()
+        return None
+    for name,value in PRAGMAS:
+        crs.execute("PRAGMA {}={}".format(name,value))
+    # bring the schema up to date; only an outdated one takes the write lock,
+    # and is checked again under it
+    crs.execute("PRAGMA user_version")
+    version=res(crs)
+    if version>len(MIGRATIONS):
+        cnx.close()
+        raise sqlite3.Error("Database schema is newer than the program")
+    if version<len(MIGRATIONS):
+        begin(crs,True)
+        with cnx:
+            migrate(crs)
+    return cnx
+
+def begin(crs,write=False):
+    """start a transaction; a write transaction takes the write lock at once,
+    retrying with a growing randomized delay while another writer holds it"""
+    for attempt in range(BUSY_RETRIES+1):
+        try:
+            crs.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            return
+        except sqlite3.OperationalError as e:
+            if attempt==BUSY_RETRIES or "locked" not in str(e) and "busy" not in str(e):
+                raise
+        time.sleep(random.uniform(0,BUSY_TIMEOUT*2**attempt/16))
+
+def next_xid(crs,n=1):
+    """allocate n consecutive transaction ids, return the first one"""
+    crs.execute("UPDATE seqs SET val=val+? WHERE name='xid'",[n])
+    crs.execute("SELECT val FROM seqs WHERE name='xid'")
+    return res(crs)-n
+
+# idle connections by (database,key), shared between threads
+POOL={}
+POOL_LOCK=threading.Lock()
+
+def pool_get(db,key):
+    """take an idle keyed connection, or open a new one"""
+    with POOL_LOCK:
+        idle=POOL.get((db,key))
+        cnx=idle.pop() if idle else None
+    if cnx is None:
+        cnx=connect(db,key)
+    if cnx is not None:
+        attach_archive(cnx,db)
+    return cnx
+
+def attach_archive(cnx,db,create=False):
+    """attach the archive of a database as schema archive if it exists, or
+    create it; return whether it is attached"""
+    path=db+ARCHIVE_SUFFIX
+    if not create and not os.path.exists(path):
+        return False
+    if cnx.execute("SELECT COUNT(*) FROM pragma_database_list WHERE name='archive'").fetchone()[0]==0:
+        # an attached database is encrypted with the key of the main one
+        cnx.execute("ATTACH DATABASE ? AS archive",[path])
+    if create:
+        cnx.execute("PRAGMA archive.journal_mode=WAL")
+        cnx.execute("""CREATE TABLE IF NOT EXISTS archive.xacts (xid integer not null, dt int not null,
+        aid integer not null, oaid integer not null, dr not null, cr not null, bal not null,
+        comment text, unique (xid, aid))""")
+        cnx.execute("CREATE INDEX IF NOT EXISTS archive.xacts_aid_dt_xid ON xacts(aid,dt,xid,bal)")
+    return True
+
+def pool_put(db,key,cnx):
+    """return a connection to the pool, or close it"""
+    if cnx.in_transaction:
+        cnx.rollback()
+    # keep only connections opened with a key some session still holds
+    keep=key is None or session_holds(db,key)
+    with POOL_LOCK:
+        if keep:
+            idle=POOL.setdefault((db,key),[])
+            if len(idle)<POOL_SIZE:
+                idle.append(cnx)
+                return
+    cnx.close()
+
+def pool_evict(db,key=None):
+    """close all idle connections to a database, or those opened with a key"""
+    with POOL_LOCK:
+        for k in [k for k in POOL if k[0]==db and (key is None or k[1]==key)]:
+            for cnx in POOL.pop(k):
+                cnx.close()
+
+# sessions by id: [database, key, time of last request], shared between threads
+SESSIONS={}
+SESSIONS_LOCK=threading.Lock()
+
+def session_id(environ):
+    """get the session id from the request cookies"""
+    try:
+        m=SimpleCookie(environ.get("HTTP_COOKIE","")).get(SESSION_COOKIE)
+    except CookieError:
+        return None
+    return m.value if m is not None else None
+
+def session_cookie(environ,sid):
+    """make the header setting the session cookie, or expiring it"""
+    path=environ.get("SCRIPT_NAME","").rstrip("/")+"/"
+    if sid is None:
+        return ("Set-Cookie","{}=; Path={}; Max-Age=0; HttpOnly; SameSite=Strict".format(SESSION_COOKIE,path))
+    return ("Set-Cookie","{}={}; Path={}; HttpOnly; SameSite=Strict".format(SESSION_COOKIE,sid,path))
+
+def session_new(db,key):
+    """open a session holding a database key, return its id"""
+    sid=secrets.token_urlsafe(24)
+    with SESSIONS_LOCK:
+        SESSIONS[sid]=[db,key,time.monotonic()]
+    return sid
+
+def session_key(environ,db):
+    """get the database key of the request's session, None if there is none;
+    drop expired sessions on the way"""
+    sid=session_id(environ)
+    now=time.monotonic()
+    with SESSIONS_LOCK:
+        expired=[k for k,s in SESSIONS.items() if now-s[2]>SESSION_TTL]
+        dropped=[SESSIONS.pop(k) for k in expired]
+        s=SESSIONS.get(sid)
+        if s is not None and s[0]==db:
+            s[2]=now
+    session_release(dropped)
+    return s[1] if s is not None and s[0]==db else None
+
+def session_end(environ):
+    """close the request's session"""
+    with SESSIONS_LOCK:
+        s=SESSIONS.pop(session_id(environ),None)
+    if s is not None:
+        session_release([s])
+
+def session_holds(db,key):
+    """tell whether a session holds a key to a database"""
+    with SESSIONS_LOCK:
+        return any(s[0]==db and s[1]==key for s in SESSIONS.values())
+
+def session_release(dropped):
+    """close the idle connections of keys no session holds any longer"""
+    for db,key,_ in dropped:
+        if key is not None and not session_holds(db,key):
+            pool_evict(db,key)
+
+def migrate(crs):
+    """bring the database schema up to date"""
+    crs.execute("PRAGMA user_version")
+    version=res(crs)
+    if version>len(MIGRATIONS):
+        raise sqlite3.Error("Database schema is newer than the program")
+    for version,stmts in enumerate(MIGRATIONS[version:],version+1):
+        for stmt in stmts:
+            if callable(stmt):
+                stmt(crs)
+            else:
+                crs.execute(stmt)
+        crs.execute("PRAGMA user_version={}".format(version))
+
 def cur2int(s):
     """convert currency string to integer"""
     s=s.replace(" ","") # drop spaces
     s=s.replace(",",DECIMAL_SEP) # always accept "," as a decimal separator
     s=s.replace(".",DECIMAL_SEP) # always accept "." as a decimal separator
-    r=""
-    i=0
-    for i,c in enumerate(s):
-        if c is DECIMAL_SEP:
-            break
-        r=r+c
-    return int(r+s[i+1:i+3].ljust(2,"0"))
+    i,_,f=s.partition(DECIMAL_SEP)
+    return int(i+f[:2].ljust(2,"0"))
+
+def db_int(s):
+    """convert an argument to an integer that fits an SQLite INTEGER"""
+    v=int(s)
+    if not -2**63<=v<2**63:
+        raise ValueError("Integer out of range")
+    return v
+
+def int2db(v):
+    """convert integer to its database value: native if it fits in 64 bits, text otherwise"""
+    if -2**63<=v<2**63:
+        return v
+    return str(v)
+
+def int2dec(v):
+    """convert integer to a plain decimal string, as exported"""
+    i,f=divmod(abs(v),100)
+    return "{}{}.{:02}".format("-" if v<0 else "",i,f)
 
 def int2cur(v):
     """convert integer to currency string"""
-    s=str(abs(v))
-    r=""
-    for i,c in enumerate(s[::-1].ljust(3,"0"),1):
-        if i==3:
-            r=DECIMAL_SEP+r
-        elif i%3==0:
-            r=THOUSAND_SEP+r
-        r=c+r
+    i,f=divmod(abs(v),100)
+    r=format(i,",").replace(",",THOUSAND_SEP)+DECIMAL_SEP+format(f,"02")
     if v<0:
         r="&minus;"+r
     return r
@@ -189,13 +907,150 @@ def res(crs):
 
 def balance(crs,aid):
     """return the current balance of account aid"""
-    crs.execute("SELECT max(xid) FROM xacts WHERE aid=?",[aid])
-    maxxid=res(crs)
-    if maxxid is not None:
-        crs.execute("SELECT bal FROM xacts WHERE xid=? and aid=?",[maxxid,aid])
-        return int(res(crs))
+    crs.execute("SELECT bal FROM acct_bals WHERE aid=?",[aid])
+    r=crs.fetchone()
+    if r is not None:
+        return int(r[0])
     return 0
 
+def refresh_balance(crs,aid):
+    """restore the materialized balance of account aid from its transactions"""
+    crs.execute("DELETE FROM acct_bals WHERE aid=?",[aid])
+    crs.execute("INSERT INTO acct_bals SELECT aid,xid,bal FROM xacts WHERE aid=? ORDER BY dt DESC,xid DESC LIMIT 1",[aid])
+
+def shift_later(crs,aid,dt,xid,delta):
+    """add delta to the running balances of the transactions of account aid
+    after position (dt,xid), to its materialized balance, and to the total of
+    its type; return the number of transactions shifted"""
+    later="aid=? AND (dt,xid)>(?,?)"
+    # running balances leaving 64 bits are shifted one by one, the rest at once
+    n=0
+    rest=[]
+    if delta==0:
+        pass
+    elif -2**63<=delta<2**63:
+        fits="typeof(bal)='integer' AND bal BETWEEN ? AND ?"
+        bounds=[-2**63-min(delta,0),2**63-1-max(delta,0)]
+        crs.execute("SELECT xid,bal FROM xacts WHERE {} AND NOT ({})".format(later,fits),[aid,dt,xid]+bounds)
+        rest=crs.fetchall()
+        crs.execute("UPDATE xacts SET bal=bal+? WHERE {} AND {}".format(later,fits),[delta,aid,dt,xid]+bounds)
+        n=crs.rowcount
+    else:
+        crs.execute("SELECT xid,bal FROM xacts WHERE {}".format(later),[aid,dt,xid])
+        rest=crs.fetchall()
+    crs.executemany("UPDATE xacts SET bal=? WHERE aid=? AND xid=?",
+    [(int2db(int(bal)+delta),aid,x) for x,bal in rest])
+    # the last transaction may change even when the balances do not
+    refresh_balance(crs,aid)
+    shift_total(crs,aid,delta)
+    return n+len(rest)
+
+# the last transaction of each account and the balance after it
+LATEST="""SELECT x.aid,x.xid,x.bal FROM accts a JOIN xacts x ON x.rowid=
+(SELECT rowid FROM xacts WHERE aid=a.aid ORDER BY dt DESC,xid DESC LIMIT 1)"""
+
+def verify_balances(crs):
+    """rebuild the materialized balances from transactions,
+    return a list of (aid,stored,actual) for those found wrong"""
+    crs.execute("SELECT aid,xid,bal FROM acct_bals")
+    stored={aid:(xid,bal) for aid,xid,bal in crs}
+    crs.execute(LATEST)
+    actual={aid:(xid,bal) for aid,xid,bal in crs}
+    wrong=[(aid,stored.get(aid),actual.get(aid))
+    for aid in sorted(stored.keys()|actual.keys()) if stored.get(aid)!=actual.get(aid)]
+    crs.execute("DELETE FROM acct_bals")
+    crs.execute("INSERT INTO acct_bals "+LATEST)
+    return wrong
+
+def rebuild_totals(crs):
+    """rebuild the total balances by account type from materialized balances,
+    return a list of (type,stored,actual) for those found wrong"""
+    crs.execute("SELECT type,total FROM type_totals")
+    stored={atc:int(total) for atc,total in crs}
+    actual={atc:0 for atc,_ in ATYPES}
+    crs.execute("SELECT type,bal FROM accts JOIN acct_bals USING (aid)")
+    for atc,bal in crs:
+        actual[atc]+=int(bal)
+    wrong=[(atc,stored.get(atc),actual[atc]) for atc,_ in ATYPES if stored.get(atc)!=actual[atc]]
+    crs.execute("DELETE FROM type_totals")
+    crs.executemany("INSERT INTO type_totals VALUES(?,?)",[(atc,int2db(v)) for atc,v in actual.items()])
+    return wrong
+
+def shift_total(crs,aid,delta):
+    """add delta to the total balance of the type of account aid"""
+    if delta!=0:
+        crs.execute("SELECT type,total FROM type_totals JOIN accts USING (type) WHERE aid=?",[aid])
+        atype,total=crs.fetchone()
+        crs.execute("UPDATE type_totals SET total=? WHERE type=?",[int2db(int(total)+delta),atype])
+
+def audit(crs):
+    """check every running balance, the two rows of every transaction, and
+    the materialized balances; generate a line per discrepancy and a summary"""
+    n=0
+    crs.execute("SELECT aid,type FROM accts ORDER BY aid")
+    types=crs.fetchall()
+    crs.execute("SELECT aid,xid,bal FROM acct_bals")
+    last={aid:(xid,int(bal)) for aid,xid,bal in crs}
+    # the running balance chain of each account
+    actual={atc:0 for atc,_ in ATYPES}
+    for aid,atype in types:
+        bal=0
+        xid=None
+        crs.execute("SELECT xid,oaid,dr,cr,bal FROM xacts WHERE aid=? ORDER BY dt,xid",[aid])
+        for xid,oaid,dr,cr,x_bal in crs:
+            # the chain starts anew from an opening balance
+            bal=int(x_bal) if oaid==aid else new_balance(atype,bal,int(dr),int(cr))
+            if int(x_bal)!=bal:
+                n+=1
+                yield "aid {} xid {}: balance {}, expected {}\n".format(aid,xid,x_bal,bal)
+                bal=int(x_bal)
+        if last.get(aid,(None,0))!=(xid,bal):
+            n+=1
+            yield "aid {}: materialized balance {}, expected {}\n".format(aid,last.get(aid),(xid,bal))
+        actual[atype]+=bal
+    # both rows of each transaction, except for the opening balances
+    crs.execute("SELECT xid,dt,aid,oaid,dr,cr FROM xacts WHERE aid<>oaid ORDER BY xid,aid")
+    for xid,rows in groupby(crs,lambda r: r[0]):
+        rows=list(rows)
+        if len(rows)!=2:
+            ok=False
+        else:
+            (_,dt1,aid1,oaid1,dr1,cr1),(_,dt2,aid2,oaid2,dr2,cr2)=rows
+            ok=(dt1==dt2 and aid1==oaid2 and oaid1==aid2
+            and int(dr1)==int(cr2) and int(cr1)==int(dr2))
+        if not ok:
+            n+=1
+            yield "xid {}: rows do not match\n".format(xid)
+    # the transaction id sequence runs ahead of every transaction
+    crs.execute("SELECT (SELECT val FROM seqs WHERE name='xid'),(SELECT MAX(xid) FROM xacts)")
+    val,maxxid=crs.fetchone()
+    if maxxid is not None and val<=maxxid:
+        n+=1
+        yield "xid sequence at {}, expected above {}\n".format(val,maxxid)
+    # totals by type and the accounting equation
+    crs.execute("SELECT type,total FROM type_totals")
+    for atc,total in crs.fetchall():
+        if int(total)!=actual[atc]:
+            n+=1
+            yield "type {}: total {}, expected {}\n".format(atc,total,actual[atc])
+    if sum(v if atc in ("E","L","i") else -v for atc,v in actual.items())!=0:
+        n+=1
+        yield "accounting equation doesn't hold\n"
+    yield "{} discrepancies\n".format(n)
+
+def audit_page(crs):
+    """run a full audit, at most once per AUDIT_INTERVAL seconds"""
+    wait=audit_page.last+AUDIT_INTERVAL-time.monotonic()
+    if audit_page.last and wait>0:
+        return HTMLResponse("429 Too Many Requests",
+        [("Content-type","text/plain"),("Retry-After",str(ceil(wait)))],
+        "Audit already run, retry in {} s".format(ceil(wait)))
+    audit_page.last=time.monotonic()
+    return HTMLResponse("200 OK",[("Content-type","text/plain")],audit(crs))
+
+# start of the last audit
+audit_page.last=0
+
 def new_balance(atype,bal,dr,cr):
     """compute the new balance after transaction"""
     if atype in ("E","L","i"):
@@ -204,53 +1059,127 @@ def new_balance(atype,bal,dr,cr):
         return bal+dr-cr
     raise ValueError("Bad account type")
 
-def main(crs):
-    """show main page"""
-    # header
-    b="""
+# page fragments, precompiled once at import time
+HEAD=fragment("""
     <!DOCTYPE html>
     <html lang="en">
     <head>
     <meta charset="UTF-8">
     <meta name="format-detection" content="telephone=no">
-    <style>
-    {}
-    </style>
+    <link rel=stylesheet href="style.css">
     <title>Double-entry Bookkeeping System</title>
     </head>
-    """.format(STYLE)
-    # body
-    b+="""
     <body>
-    """
+    """)
+CELLAR=fragment("""
+    </body>
+    </html>
+    """)
+MAIN_TYPE=fragment("""
+    <strong>{}</strong>
+    <div class=indent>
+    <table>
+    """)
+MAIN_ACCT=fragment("""
+    <tr>
+    <td><a href="acct?aid={}">{}</a></td>
+    <td class=r>&nbsp; {}</td>
+    </tr>
+    """)
+MAIN_TOTAL=fragment("""
+    <tr class=sep_tot>
+    <td>Total</td>
+    <td class=r>&nbsp; {}</td>
+    </tr>
+    <tr><td colspan=2>&nbsp;</td></tr>
+    </table>
+    </div>
+    """)
+MAIN_NEW_ACCT=fragment("""
+    <hr>
+    <form action=creat_acct method=post>
+    New account &nbsp;
+    <select name=atype>
+    <option value="">&nbsp;</option>
+    {}
+    </select>
+    <input type=text name=aname>
+    <input type=submit value=Create>
+    </form>
+    <hr>
+    Reports: &nbsp;
+    <a href="trial_bal">Trial balance</a> &nbsp;
+    <a href="income_stmt">Income statement</a> &nbsp;
+    <a href="monthly">Monthly changes</a> &nbsp;
+    <a href="search">Search</a>
+    <hr>
+    <h3>Closed accounts</h3>
+    """)
+OPTION=fragment("""
+    <option value="{}">{}</option>
+    """)
+MAIN_CLOSED_TYPE=fragment("""
+    <strong>{}</strong>
+    <div class=indent>
+    """)
+MAIN_CLOSED_ACCT=fragment("""
+    <a href="acct?aid={}">{}</a><br>
+    """)
+MAIN_CLOSED_END=fragment("""
+    </div>
+    """)
+MAIN_CLR_DBKEY=fragment("""
+    <hr>
+    <a href="clr_dbkey">Close session</a>
+    """)
+
+# account directories by database file, as read at an accounts version
+Directory=namedtuple("Directory",["version","accts","names","options"])
+DIRECTORIES={}
+DIRECTORIES_LOCK=threading.Lock()
+
+def directory(crs):
+    """get the account directory of the database: accts maps aid to (type,name,odt,cdt),
+    names lists the aids in the order of their names, options holds the option
+    groups of the open accounts; read the accounts again only after they changed"""
+    crs.execute("SELECT (SELECT val FROM seqs WHERE name='accts'),(SELECT file FROM pragma_database_list WHERE name='main')")
+    version,db=crs.fetchone()
+    with DIRECTORIES_LOCK:
+        d=DIRECTORIES.get(db)
+    if d is not None and d.version==version:
+        return d
+    crs.execute("SELECT aid,type,name,odt,cdt FROM accts ORDER BY name")
+    rows=crs.fetchall()
+    groups=[]
+    for atc,atn in ATYPES:
+        opts=[OPTION.format(aid,name) for aid,atype,name,_,cdt in rows if atype==atc and cdt==0]
+        groups.append(OPTGROUP.format(atn,"".join(opts) if opts else EMPTY_OPTION))
+    d=Directory(version,{aid:(atype,name,odt,cdt) for aid,atype,name,odt,cdt in rows},
+    [r[0] for r in rows],"".join(groups))
+    # a directory read from an older snapshot does not replace a newer one
+    with DIRECTORIES_LOCK:
+        if db not in DIRECTORIES or DIRECTORIES[db].version<version:
+            DIRECTORIES[db]=d
+    return d
+
+def main(crs,environ):
+    """show main page"""
+    # header
+    b=[HEAD]
     # accounts
-    totals={}
+    accts={atc:[] for atc,_ in ATYPES}
+    crs.execute("""SELECT type,aid,name,bal FROM accts LEFT JOIN acct_bals USING (aid)
+    WHERE cdt=0 ORDER BY name""")
+    for atc,aid,name,bal in crs:
+        accts[atc].append((aid,name,int(bal) if bal is not None else 0))
+    # totals, maintained on every change
+    crs.execute("SELECT type,total FROM type_totals")
+    totals={atc:int(total) for atc,total in crs}
     for atc,atn in ATYPES:
-        b+="""
-        <strong>{}</strong>
-        <div class=indent>
-        <table>
-        """.format(atn)
-        totals[atc]=0
-        crs.execute("SELECT aid,name FROM accts WHERE type=? AND cdt=0 ORDER BY name",[atc])
-        for (aid,name) in crs.fetchall():
-            bal=balance(crs,aid)
-            totals[atc]+=bal
-            b+="""
-            <tr>
-            <td><a href="acct?aid={}">{}</a></td>
-            <td class=r>&nbsp; {}</td>
-            </tr>
-            """.format(aid,name,int2cur(bal))
-        b+="""
-        <tr class=sep_tot>
-        <td>Total</td>
-        <td class=r>&nbsp; {}</td>
-        </tr>
-        <tr><td colspan=2>&nbsp;</td></tr>
-        </table>
-        </div>
-        """.format(int2cur(totals[atc]))
+        b.append(MAIN_TYPE.format(atn))
+        for aid,name,bal in accts[atc]:
+            b.append(MAIN_ACCT.format(aid,name,int2cur(bal)))
+        b.append(MAIN_TOTAL.format(int2cur(totals[atc])))
     # verify accounting equation
     d=0
     for atc in ("E","L","i"):
@@ -260,110 +1189,36 @@ def main(crs):
     if d!=0:
         raise sqlite3.Error("Accounting equation doesn't hold")
     # new account
-    b+="""
-    <hr>
-    <form action=creat_acct method=post>
-    New account &nbsp;
-    <select name=atype>
-    <option value="">&nbsp;</option>
-    """
-    for atc,atn in ATYPES:
-        b+="""
-        <option value="{}">{}</option>
-        """.format(atc,atn)
-    b+="""
-    </select>
-    <input type=text name=aname>
-    <input type=submit value=Create>
-    </form>
-    """
+    b.append(MAIN_NEW_ACCT.format("".join(OPTION.format(atc,atn) for atc,atn in ATYPES)))
     # closed accounts
-    b+="""
-    <hr>
-    <h3>Closed accounts</h3>
-    """
+    accts=directory(crs)
     for atc,atn in ATYPES:
-        b+="""
-        <strong>{}</strong>
-        <div class=indent>
-        """.format(atn)
-        crs.execute("SELECT aid,name FROM accts WHERE type=? AND cdt<>0 ORDER BY name",[atc])
-        for aid,name in crs:
-            b+="""
-            <a href="acct?aid={}">{}</a><br>
-            """.format(aid,name)
-        b+="""
-        </div>
-        """
+        b.append(MAIN_CLOSED_TYPE.format(atn))
+        for aid in accts.names:
+            atype,name,_,cdt=accts.accts[aid]
+            if atype==atc and cdt!=0:
+                b.append(MAIN_CLOSED_ACCT.format(aid,name))
+        b.append(MAIN_CLOSED_END)
     # show clear key link
-    if application.dbkey is not None:
-        b+="""
-        <hr>
-        <a href="clr_dbkey">Close session</a>
-        """
+    if environ.get("debs.dbkey") is not None:
+        b.append(MAIN_CLR_DBKEY)
     # cellar
-    b+="""
-    </body>
-    </html>
-    """
+    b.append(CELLAR)
     # return success
-    return HTMLResponse("200 OK",[("Content-type","text/html")],b)
+    return HTMLResponse("200 OK",[("Content-type","text/html")],"".join(b))
 
-def acct(crs,qs):
-    """show account statement page"""
-    # get arguments
-    q=parse_qs(qs,keep_blank_values=True)
-    # get and check aid
-    try:
-        aid=q["aid"][0]
-    except KeyError as e:
-        raise ValueError("Wrong access") from e
-    crs.execute("SELECT COUNT(*) FROM accts WHERE aid=?",[aid])
-    if res(crs)==0:
-        raise ValueError("Bad aid")
-    # get and check the page number
-    crs.execute("SELECT COUNT(*) FROM xacts WHERE aid=?",[aid])
-    lastpage=ceil(res(crs)/LIMIT)
-    if lastpage==0:
-        lastpage=1
-    try:
-        page=int(q["page"][0])
-        if page<1 or page>lastpage:
-            raise ValueError
-    except (KeyError,ValueError):
-        page=1
-    # get commonly used account properties
-    crs.execute("SELECT name,cdt FROM accts WHERE aid=?",[aid])
-    aname,cdt=crs.fetchone()
-    bal=balance(crs,aid)
-    crs.execute("SELECT MAX(xid) FROM xacts WHERE aid=?",[aid])
-    maxxid=res(crs)
-    if maxxid is None:
-        maxxid=0
-    # header
-    b="""
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-    <meta charset="UTF-8">
-    <meta name="format-detection" content="telephone=no">
-    <style>
-    {}
-    </style>
-    <title>Double-entry Bookkeeping System</title>
-    </head>
-    """.format(STYLE)
-    # body
-    b+="""
-    <body>
+ACCT_HEAD=fragment("""
     <div class=center>
     <h2>{}</h2>
     </div>
     <a href=".">Back to list</a>
+    <form class=inline action=acct method=get>
+    &nbsp; <input type=hidden name=aid value="{}">
+    Balance as of <input type=text name=asof size=10 maxlength=10 class=w12 value="{}">
+    <input type=submit value=Show>
+    {}
+    </form>
     <hr>
-    """.format(aname)
-    # transactions
-    b+="""
     <table class=full>
     <tr class=line>
     <th class=date>Date</th>
@@ -373,69 +1228,202 @@ def acct(crs,qs):
     <th class=opp>Opposing account</th>
     <th class=comm>Comment</th>
     </tr>
-    """
+    """)
+ACCT_NEW_XACT=fragment("""
+    <tr class=line><td colspan=6>
+    <form action=ins_xact method=post>
+    <table class=full>
+    <tr class=line>
+    <td class=date>
+    <input type=text name=yyyy size=4 maxlength=4 class=w4 value="{}">
+    <input type=text name=mm size=2 maxlength=2 class=w2 value="{}">
+    <input type=text name=dd size=2 maxlength=2 class=w2 value="{}">
+    </td>
+    <td class=dr><input type=text size=12 class=w12 name=dr></td>
+    <td class=cr><input type=text size=12 class=w12 name=cr></td>
+    <td class=bal><input type=text size=12 class=w12 name=newbal></td>
+    <td class=opp>
+    <input type=hidden name=aid value="{}">
+    <select name=oaid>
+    <option value="-1">&nbsp;</option>
+    {}
+    </select>
+    </td>
+    <td class=comm>
+    <input type=text name=comment size=20 class=comm maxlength=255>
+    <input type=submit value=Insert>
+    </td>
+    </tr>
+    </table>
+    </form>
+    </td></tr>
+    """)
+OPTGROUP=fragment("""
+    <optgroup label="{}">
+    {}
+    </optgroup>
+    """)
+EMPTY_OPTION=fragment("""
+    <option>&nbsp;</option>
+    """)
+ACCT_XACT=fragment("""
+    <tr class="line {}">
+    <td class=date>{}</td>
+    <td class=dr>{}</td>
+    <td class=cr>{}</td>
+    <td class=bal>{}</td>
+    <td class=opp><span class=atype>{}</span>&nbsp;{}</td>
+    <td class=comm>&nbsp;<small>{}</small>
+    {}
+    </td>
+    </tr>
+    """)
+ACCT_DEL_XACT=fragment("""
+    <form class=inline action=del_xact method=post>
+    <input type=hidden name=xid value="{}">
+    <input type=hidden name=aid value="{}">
+    <input type=submit value="Delete">
+    </form>
+    """)
+ACCT_PAGES=fragment("""
+    </table>
+    <hr>
+    """)
+ACCT_PAGE=fragment("""
+    <a href="acct?aid={}">{}</a>&nbsp;
+    """)
+ACCT_PAGE_CURSOR=fragment("""
+    <a href="acct?aid={}&amp;before_xid={}">{}</a>&nbsp;
+    """)
+ACCT_PAGE_OFF=fragment("""
+    {}&nbsp;
+    """)
+ACCT_CLOSE=fragment("""
+    <hr>
+    <div class="center form">
+    <form action=close_acct method=post>
+    <input type=hidden name=aid value="{}">
+    <input type=submit value="Close account">
+    </form>
+    </div>
+    """)
+
+def acct(crs,qs):
+    """show account statement page"""
+    # get arguments
+    q=parse_qs(qs,keep_blank_values=True)
+    # get and check aid
+    try:
+        aid=q["aid"][0]
+    except KeyError as e:
+        raise ValueError("Wrong access") from e
+    accts=directory(crs)
+    try:
+        _,aname,_,cdt=accts.accts[int(aid)]
+    except (KeyError,ValueError) as e:
+        raise ValueError("Bad aid") from e
+    # get the page cursor: the page shows transactions older than the
+    # transaction before_xid, in the order of (dt,xid)
+    asof=get_date(q,"asof",None) if q.get("asof",[""])[0] else None
+    try:
+        before=db_int(q["before_xid"][0])
+    except (KeyError,ValueError):
+        before=None
+        # map the page number of old bookmarks onto a cursor
+        try:
+            page=int(q["page"][0])
+            if page>1:
+                crs.execute("SELECT xid FROM xacts WHERE aid=? ORDER BY dt DESC,xid DESC LIMIT 2 OFFSET ?",
+                [aid,db_int((page-1)*LIMIT-1)])
+                r=crs.fetchall()
+                if len(r)==2:
+                    before=r[0][0]
+        except (KeyError,ValueError):
+            pass
+    closed=period(crs)
+    if before is not None:
+        crs.execute("SELECT dt,xid FROM xacts WHERE aid=? AND xid=?",[aid,before])
+        r=crs.fetchone()
+        if r is None and closed:
+            crs.execute("SELECT dt,xid FROM archive.xacts WHERE aid=? AND xid=? AND dt<?",[aid,before,closed])
+            r=crs.fetchone()
+        before=r
+    bal=balance(crs,aid)
+    # start the statement at the given date
+    if asof is not None:
+        _,asof_bal=balance_asof(crs,aid,asof)
+        before=(asof,2**63-1)
+        asof_d=date.fromordinal(asof)
+        asof_bal="&nbsp; "+int2cur(asof_bal)
+    else:
+        asof_d=asof_bal=""
+    # header
+    b=[HEAD,ACCT_HEAD.format(aname,aid,asof_d,asof_bal)]
     # new transaction
     if cdt==0:
         d=date.today()
-        yyyy=d.year
-        mm=d.month
-        dd=d.day
-        b+="""
-        <tr class=line><td colspan=6>
-        <form action=ins_xact method=post>
-        <table class=full>
-        <tr class=line>
-        <td class=date>
-        <input type=text name=yyyy size=4 maxlength=4 class=w4 value="{}">
-        <input type=text name=mm size=2 maxlength=2 class=w2 value="{}">
-        <input type=text name=dd size=2 maxlength=2 class=w2 value="{}">
-        </td>
-        <td class=dr><input type=text size=12 class=w12 name=dr></td>
-        <td class=cr><input type=text size=12 class=w12 name=cr></td>
-        <td class=bal><input type=text size=12 class=w12 name=newbal></td>
-        <td class=opp>
-        <input type=hidden name=aid value="{}">
-        <select name=oaid>
-        <option value="-1">&nbsp;</option>
-        """.format(yyyy,mm,dd,aid)
-        for atc,atn in ATYPES:
-            b+="""
-            <optgroup label="{}">
-            """.format(atn)
-            crs.execute("SELECT aid,name FROM accts WHERE type=? AND cdt=0 ORDER BY name",[atc])
-            opts=crs.fetchall()
-            for oaid,oaname in opts:
-                b+="""
-                <option value="{}">{}</option>
-                """.format(oaid,oaname)
-            if len(opts)==0:
-                b+="""
-                <option>&nbsp;</option>
-                """
-            b+="""
-            </optgroup>
-            """
-        b+="""
-        </select>
-        </td>
-        <td class=comm>
-        <input type=text name=comment size=20 class=comm maxlength=255>
-        <input type=submit value=Insert>
-        </td>
-        </tr>
-        </table>
-        </form>
-        </td></tr>
-        """
+        b.append(ACCT_NEW_XACT.format(d.year,d.month,d.day,aid,accts.options))
+    # return success, streaming the transactions
+    return HTMLResponse("200 OK",[("Content-type","text/html")],
+    chain(b,acct_xacts(crs,aid,before,cdt,bal,closed)))
+
+def ledger(closed):
+    """return the tables of transactions newest first, each with the day its
+    transactions are dated before: every archived transaction is older than the
+    opening balances, and so than every transaction left open, while what an
+    interrupted close copied from the open period is not archived yet"""
+    return [("xacts",2**63-1)]+([("archive.xacts",closed)] if closed else [])
+
+def statement_rows(crs,aid,before,limit,closed=0):
+    """return up to limit transactions of account aid older than the (dt,xid)
+    cursor before, newest first, with the type, name and closing date of their
+    opposing accounts; once a period was closed, the archive is read when the
+    open period runs out"""
+    rows=[]
+    for src,end in ledger(closed):
+        crs.execute("""SELECT x.xid,x.dt,x.aid,x.oaid,x.dr,x.cr,x.bal,x.comment,a.type,a.name,a.cdt
+        FROM {} x JOIN accts a ON a.aid=x.oaid
+        WHERE x.aid=? AND (x.dt,x.xid)<(?,?) AND x.dt<? ORDER BY x.dt DESC,x.xid DESC LIMIT ?""".format(src),
+        [aid]+list(before or (2**63-1,2**63-1))+[end,limit-len(rows)])
+        rows+=crs.fetchall()
+        if len(rows)>=limit:
+            break
+    return rows
+
+def statement_xid(crs,aid,after,n,closed=0):
+    """return the id of the transaction of account aid n places after the
+    (dt,xid) cursor after, oldest first, or None if there are not so many"""
+    for src,end in reversed(ledger(closed)):
+        crs.execute("SELECT xid FROM {} WHERE aid=? AND (dt,xid)>=(?,?) AND dt<? ORDER BY dt,xid LIMIT 1 OFFSET ?".format(src),
+        [aid]+list(after)+[end,n])
+        r=crs.fetchone()
+        if r is not None:
+            return r[0]
+        # skip the transactions of this table
+        crs.execute("SELECT COUNT(*) FROM (SELECT 1 FROM {} WHERE aid=? AND (dt,xid)>=(?,?) AND dt<? LIMIT ?)".format(src),
+        [aid]+list(after)+[end,n])
+        n-=res(crs)
+    return None
+
+def acct_xacts(crs,aid,before,cdt,bal,closed):
+    """generate the rest of account statement page: transactions and links;
+    before is the (dt,xid) cursor of the page or None for the newest one,
+    closed the first day of the open period"""
     # past transactions
     prev_year=None
     prev_month=None
-    crs.execute("SELECT * FROM xacts WHERE aid=? ORDER BY xid DESC LIMIT ? OFFSET ?",
-    [aid,LIMIT,(page-1)*LIMIT])
-    for (xid,dt,aid,oaid,dr,cr,x_bal,comment) in crs.fetchall():
+    n=0
+    older=None
+    for (xid,dt,aid,oaid,dr,cr,x_bal,comment,oatype,oaname,oacdt) in statement_rows(crs,aid,before,LIMIT+1,closed):
+        # the extra row only tells whether there are older transactions
+        n+=1
+        if n>LIMIT:
+            older=prev_xid
+            break
+        prev_xid=xid
         dt_d=date.fromordinal(dt)
-        dr=int2cur(int(dr)) if dr!="0" else ""
-        cr=int2cur(int(cr)) if cr!="0" else ""
+        dr=int2cur(int(dr)) if dr!=0 else ""
+        cr=int2cur(int(cr)) if cr!=0 else ""
         x_bal=int2cur(int(x_bal))
         x_year=dt_d.year
         x_month=dt_d.month
@@ -449,84 +1437,92 @@ def acct(crs,qs):
             sep_class="sep"
         prev_year=x_year
         prev_month=x_month
-        crs.execute("SELECT type,name,cdt FROM accts WHERE aid=?",[oaid])
-        oatype,oaname,oacdt=crs.fetchone()
-        b+="""
-        <tr class="line {}">
-        <td class=date>{}</td>
-        <td class=dr>{}</td>
-        <td class=cr>{}</td>
-        <td class=bal>{}</td>
-        <td class=opp><span class=atype>{}</span>&nbsp;{}</td>
-        <td class=comm>&nbsp;<small>{}</small>
-        """.format(sep_class,dt_d,dr,cr,x_bal,oatype,oaname,comment)
-        # we can delete the transaction if it is the last one for both aid and oaid
-        # and both accounts are still open
-        if xid==maxxid and cdt==0 and oacdt==0:
-            crs.execute("SELECT MAX(xid) FROM xacts WHERE aid=?",[oaid])
-            if xid==res(crs):
-                b+="""
-                <form class=inline action=del_xact method=post>
-                <input type=hidden name=xid value="{}">
-                <input type=hidden name=aid value="{}">
-                <input type=submit value="Delete">
-                </form>
-                """.format(xid,aid)
-        b+="""
-        </td>
-        </tr>
-        """
-    b+="""
-    </table>
-    """
-    # links to pages
-    b+="""
-    <hr>
-    Page
-    """
-    for p in range(1,lastpage+1):
-        if p!=page:
-            b+="""
-            <a href="acct?aid={0}&amp;page={1}">{1}</a>&nbsp;
-            """.format(aid,p)
+        # we can delete the transaction if both accounts are still open,
+        # unless it is an opening balance or archived
+        if cdt==0 and oacdt==0 and oaid!=aid and dt>=closed:
+            del_form=ACCT_DEL_XACT.format(xid,aid)
+        else:
+            del_form=""
+        yield ACCT_XACT.format(sep_class,dt_d,dr,cr,x_bal,oatype,oaname,comment,del_form)
+    # links to pages: seek from the cursors of the neighbouring and the end pages
+    newer=oldest=None
+    if before is not None:
+        newer=statement_xid(crs,aid,before,LIMIT,closed)
+    if older is not None:
+        oldest=statement_xid(crs,aid,(-2**63,-2**63),LIMIT,closed)
+    yield ACCT_PAGES
+    for label,enabled,cursor in (("Newest",before is not None,None),
+    ("Newer",before is not None,newer),
+    ("Older",older is not None,older),
+    ("Oldest",older is not None,oldest)):
+        if enabled and cursor is None:
+            yield ACCT_PAGE.format(aid,label)
+        elif enabled:
+            yield ACCT_PAGE_CURSOR.format(aid,cursor,label)
         else:
-            b+="""
-            {}&nbsp;
-            """.format(p)
+            yield ACCT_PAGE_OFF.format(label)
     # close the account
     if bal==0 and cdt==0:
-        b+="""
-        <hr>
-        <div class="center form">
-        <form action=close_acct method=post>
-        <input type=hidden name=aid value="{}">
-        <input type=submit value="Close account">
-        </form>
-        </div>
-        """.format(aid)
+        yield ACCT_CLOSE.format(aid)
     # cellar
-    b+="""
-    </body>
-    </html>
-    """
-    # return success
-    return HTMLResponse("200 OK",[("Content-type","text/html")],b)
+    yield CELLAR
 
 def ins_xact(crs,environ):
     """insert a new transaction"""
     # get arguments
+    qs=environ["wsgi.input"].readline().decode()
+    q={k:v[0] for k,v in parse_qs(qs,keep_blank_values=True).items()}
+    # check them against the database, keeping the balances the transaction starts from
+    bals={}
+    closed=period(crs)
+    def state(aid,dt):
+        if dt<closed:
+            raise BadInput("Period closed")
+        bals[aid]=balance_asof(crs,aid,dt)[1]
+        return bals[aid]
+    dt,aid,oaid,dr,cr,newbal,onewbal,comment=check_xact(q,partial(open_acct,directory(crs)),state)
+    environ["debs.stale"]={aid,oaid}
+    # insert transaction
+    xid=next_xid(crs)
+    crs.execute("INSERT INTO xacts VALUES(?,?,?,?,?,?,?,?)",
+    [xid,dt,aid,oaid,int2db(dr),int2db(cr),int2db(newbal),comment])
+    crs.execute("INSERT INTO xacts VALUES(?,?,?,?,?,?,?,?)",
+    [xid,dt,oaid,aid,int2db(cr),int2db(dr),int2db(onewbal),comment])
+    # shift the running balances of later transactions of a back-dated one,
+    # update materialized balances and totals
+    start=time.perf_counter()
+    n=shift_later(crs,aid,dt,xid,newbal-bals[aid])+shift_later(crs,oaid,dt,xid,onewbal-bals[oaid])
+    # return redirect
+    return HTMLResponse("303 See Other",[("Location","acct?aid={}".format(aid)),
+    repair_timing(start,n)],"")
+
+def repair_timing(start,n):
+    """make the header reporting the cost of shifting running balances"""
+    return ("Server-Timing",'repair;dur={:.1f};desc="{} balances"'.format((time.perf_counter()-start)*1000,n))
+
+def open_acct(accts,aid):
+    """return (type,odt) of open account aid of an account directory, or None"""
+    a=accts.accts.get(aid)
+    if a is None or a[3]!=0:
+        return None
+    return a[0],a[2]
+
+def check_xact(q,acct,state):
+    """check a new transaction given as a dictionary of form fields;
+    acct(aid) returns (type,odt) of an open account or None, state(aid,dt)
+    returns its balance at the end of day dt, where the transaction goes;
+    return the values (dt,aid,oaid,dr,cr,newbal,onewbal,comment) to insert"""
+    # get arguments
     try:
-        qs=environ["wsgi.input"].readline().decode()
-        q=parse_qs(qs,keep_blank_values=True)
-        yyyy=q["yyyy"][0]
-        mm=q["mm"][0]
-        dd=q["dd"][0]
-        dr=q["dr"][0]
-        cr=q["cr"][0]
-        newbal=q["newbal"][0]
-        aid=q["aid"][0]
-        oaid=q["oaid"][0]
-        comment=escape(q["comment"][0])
+        yyyy=q["yyyy"]
+        mm=q["mm"]
+        dd=q["dd"]
+        dr=q["dr"]
+        cr=q["cr"]
+        newbal=q["newbal"]
+        aid=q["aid"]
+        oaid=q["oaid"]
+        comment=escape(q["comment"])
     except KeyError as e:
         raise ValueError("Wrong access") from e
     # check accounts
@@ -534,20 +1530,22 @@ def ins_xact(crs,environ):
         aid=int(aid)
     except ValueError as e:
         raise ValueError("Bad aid") from e
-    crs.execute("SELECT COUNT(aid) FROM accts WHERE aid=? AND cdt=0",[aid])
-    if res(crs)==0:
+    ainfo=acct(aid)
+    if ainfo is None:
         raise ValueError("Non-existent aid")
     try:
         oaid=int(oaid)
     except ValueError as e:
         raise ValueError("Bad oaid") from e
-    crs.execute("SELECT COUNT(aid) FROM accts WHERE aid=? AND cdt=0",[oaid])
-    if res(crs)==0 and oaid!=-1:
+    oainfo=acct(oaid)
+    if oainfo is None and oaid!=-1:
         raise ValueError("Non-existent oaid")
     if oaid==-1:
         raise BadInput("Please select the opposing account")
     if aid==oaid:
         raise BadInput("Transaction with the same account")
+    atype,odt=ainfo
+    oatype,oodt=oainfo
     # check date
     try:
         dt=date(int(yyyy),int(mm),int(dd)).toordinal()
@@ -584,27 +1582,13 @@ def ins_xact(crs,environ):
     # check dates
     if dt>date.today().toordinal():
         raise BadInput("Date cannot be in the future")
-    crs.execute("SELECT odt FROM accts WHERE aid=?",[aid])
-    if dt<res(crs):
+    if dt<odt:
         raise BadInput("Date before the account's opening date")
-    crs.execute("SELECT odt FROM accts WHERE aid=?",[oaid])
-    if dt<res(crs):
+    if dt<oodt:
         raise BadInput("Date before the opposing account's opening date")
-    crs.execute("SELECT COUNT(*) FROM xacts WHERE aid=? AND dt>?",[aid,dt])
-    if res(crs)!=0:
-        raise BadInput("Current account has newer transactions")
-    crs.execute("SELECT COUNT(*) FROM xacts WHERE aid=? AND dt>?",[oaid,dt])
-    if res(crs)!=0:
-        raise BadInput("Opposing account has newer transactions")
-    # input data OK, prepare to insert transaction
-    # get account types
-    crs.execute("SELECT type FROM accts WHERE aid=?",[aid])
-    atype=res(crs)
-    crs.execute("SELECT type FROM accts WHERE aid=?",[oaid])
-    oatype=res(crs)
-    # get account balances
-    bal=balance(crs,aid)
-    obal=balance(crs,oaid)
+    bal=state(aid,dt)
+    obal=state(oaid,dt)
+    # input data OK, compute balances
     if dr==0 and cr==0:
         # derive dr and cr from new and old balances
         if atype in ("E","L","i"):
@@ -623,19 +1607,387 @@ def ins_xact(crs,environ):
         newbal=new_balance(atype,bal,dr,cr)
     # compute new balance of the opposing account, with dr and cr exchanged
     onewbal=new_balance(oatype,obal,cr,dr)
-    # insert transaction
-    crs.execute("SELECT MAX(xid) FROM xacts")
-    maxxid=res(crs)
-    if maxxid is None:
-        xid=0
+    return dt,aid,oaid,dr,cr,newbal,onewbal,comment
+
+def import_xacts(crs,lines,fmt):
+    """insert transactions read from CSV or newline-delimited JSON lines, or
+    from a columnar export through its read function, checking them like
+    ins_xact() does; the second row of an exported transaction is skipped;
+    return the number of transactions inserted and a list of (record
+    number,error) for the rejected ones"""
+    # load accounts and their current state once
+    accts={aid:(atype,odt) for aid,(atype,_,odt,cdt) in directory(crs).accts.items() if cdt==0}
+    crs.execute("SELECT b.aid,b.bal,x.dt FROM acct_bals b JOIN xacts x ON x.xid=b.xid AND x.aid=b.aid")
+    states={aid:(int(bal),dt) for aid,bal,dt in crs}
+    crs.execute("SELECT val FROM seqs WHERE name='xid'")
+    xid=first=res(crs)
+    # check and insert the records in batches
+    if fmt=="csv":
+        records=csv.DictReader(lines)
+    elif fmt=="json":
+        records=(line for line in lines if line.strip())
+    elif fmt=="columns":
+        records=columns_records(lines)
     else:
-        xid=maxxid+1
-    crs.execute("INSERT INTO xacts VALUES(?,?,?,?,?,?,?,?)",
-    [xid,dt,aid,oaid,str(dr),str(cr),str(newbal),comment])
-    crs.execute("INSERT INTO xacts VALUES(?,?,?,?,?,?,?,?)",
-    [xid,dt,oaid,aid,str(cr),str(dr),str(onewbal),comment])
-    # return redirect
-    return HTMLResponse("303 See Other",[("Location","acct?aid={}".format(aid))],"")
+        raise ValueError("Wrong format")
+    rows=[]
+    count=0
+    errors=[]
+    changed=set()
+    deltas={atc:0 for atc,_ in ATYPES}
+    # imports only append to the accounts
+    closed=period(crs)
+    def state(aid,dt):
+        if dt<closed:
+            raise BadInput("Period closed")
+        bal,lastdt=states.get(aid,(0,None))
+        if lastdt is not None and lastdt>dt:
+            raise BadInput("Account has newer transactions")
+        return bal
+    prev=None
+    for n,r in enumerate(records,1):
+        try:
+            if fmt=="json":
+                r=json.loads(r)
+                if not isinstance(r,dict):
+                    raise BadInput("Not an object")
+            q=import_fields(r)
+            if q.get("xid","")!="" and q["xid"]==prev:
+                continue
+            prev=q.get("xid")
+            dt,aid,oaid,dr,cr,newbal,onewbal,comment=check_xact(q,accts.get,state)
+        except (ValueError,BadInput) as e:
+            errors.append((n,str(e)))
+            continue
+        rows.append([xid,dt,aid,oaid,int2db(dr),int2db(cr),int2db(newbal),comment])
+        rows.append([xid,dt,oaid,aid,int2db(cr),int2db(dr),int2db(onewbal),comment])
+        deltas[accts[aid][0]]+=newbal-states.get(aid,(0,None))[0]
+        deltas[accts[oaid][0]]+=onewbal-states.get(oaid,(0,None))[0]
+        states[aid]=(newbal,dt)
+        states[oaid]=(onewbal,dt)
+        changed.update((aid,oaid))
+        xid+=1
+        count+=1
+        if len(rows)>=IMPORT_BATCH:
+            crs.executemany("INSERT INTO xacts VALUES(?,?,?,?,?,?,?,?)",rows)
+            rows=[]
+    crs.executemany("INSERT INTO xacts VALUES(?,?,?,?,?,?,?,?)",rows)
+    next_xid(crs,xid-first)
+    # update materialized balances and totals
+    for aid in changed:
+        refresh_balance(crs,aid)
+    crs.execute("SELECT type,total FROM type_totals")
+    crs.executemany("UPDATE type_totals SET total=? WHERE type=?",
+    [(int2db(int(total)+deltas[atc]),atc) for atc,total in crs.fetchall() if deltas[atc]!=0])
+    return count,errors
+
+def import_fields(r):
+    """turn an imported record into the form fields of a new transaction"""
+    q={k:"" if v is None else str(v) for k,v in r.items() if k is not None}
+    # accept a single ISO date instead of separate fields
+    if "date" in q:
+        try:
+            q["yyyy"],q["mm"],q["dd"]=q.pop("date").split("-")
+        except ValueError as e:
+            raise BadInput("Bad date") from e
+    for k in ("dr","cr","newbal","comment"):
+        q.setdefault(k,"")
+    # an exported transaction of zero amount keeps the balance it left
+    if q["newbal"]=="" and q.get("bal","")!="" and all(zero_amount(q[k]) for k in ("dr","cr")):
+        q["newbal"]=q["bal"]
+    return q
+
+def zero_amount(s):
+    """tell whether an amount field is empty or zero"""
+    try:
+        return s=="" or cur2int(s)==0
+    except ValueError:
+        return False
+
+def request_lines(environ):
+    """iterate over the lines of a request body"""
+    left=int(environ.get("CONTENT_LENGTH") or 0)
+    while left>0:
+        line=environ["wsgi.input"].readline(left)
+        if not line:
+            break
+        left-=len(line)
+        yield line.decode()
+
+def import_report(count,errors):
+    """describe the outcome of an import"""
+    return "".join(["{} transaction(s) imported, {} rejected\n".format(count,len(errors))]+
+    ["record {}: {}\n".format(n,e) for n,e in errors])
+
+def request_reader(environ):
+    """make a function reading up to n bytes of a request body"""
+    left=[int(environ.get("CONTENT_LENGTH") or 0)]
+    def read(n):
+        b=environ["wsgi.input"].read(min(n,left[0]))
+        left[0]-=len(b)
+        return b
+    return read
+
+def bulk_import(crs,environ):
+    """insert transactions posted as CSV, newline-delimited JSON or a columnar export"""
+    ctype=environ.get("CONTENT_TYPE","")
+    if ctype.startswith("text/csv"):
+        count,errors=import_xacts(crs,request_lines(environ),"csv")
+    elif ctype.startswith("application/octet-stream"):
+        count,errors=import_xacts(crs,request_reader(environ),"columns")
+    else:
+        count,errors=import_xacts(crs,request_lines(environ),"json")
+    return HTMLResponse("200 OK",[("Content-type","text/plain")],import_report(count,errors))
+
+def export(crs,qs):
+    """stream the transactions of an account, or all of them"""
+    q=parse_qs(qs or "")
+    fmt=q.get("fmt",["csv"])[0]
+    if fmt not in EXPORTS:
+        raise ValueError("Wrong format")
+    aid=q.get("aid",[None])[0]
+    if aid is not None:
+        crs.execute("SELECT COUNT(*) FROM accts WHERE aid=?",[aid])
+        if res(crs)==0:
+            raise ValueError("Bad aid")
+    check_export(crs,fmt,aid)
+    ctype,ext=EXPORTS[fmt]
+    name="ledger" if aid is None else "acct{}".format(aid)
+    return HTMLResponse("200 OK",[("Content-type",ctype),
+    ("Content-Disposition",'attachment; filename="{}.{}"'.format(name,ext))],
+    EXPORTERS[fmt](crs,aid))
+
+def check_export(crs,fmt,aid):
+    """refuse an export the format cannot hold, before anything is sent"""
+    if fmt=="columns":
+        # amounts beyond 64 bits are stored as text
+        sql="SELECT COUNT(*) FROM (SELECT 1 FROM {} WHERE 'text' IN (typeof(dr),typeof(cr),typeof(bal)){} LIMIT 1)"
+        for src,_ in ledger(period(crs)):
+            if aid is None:
+                crs.execute(sql.format(src,""))
+            else:
+                crs.execute(sql.format(src," AND aid=?"),[aid])
+            if res(crs):
+                raise BadInput("Amounts beyond 64 bits, export as CSV or JSON")
+
+def export_batches(crs,aid):
+    """generate batches of transaction rows of an account, or of all accounts,
+    archived ones first, fetching EXPORT_BATCH rows at once; the opening
+    balances of a close are left out, as the archived rows before them make
+    them up"""
+    sql="SELECT xid,dt,aid,oaid,dr,cr,bal,comment FROM {} WHERE aid!=oaid AND dt<?{}"
+    for src,end in reversed(ledger(period(crs))):
+        if aid is None:
+            crs.execute(sql.format(src," ORDER BY dt,xid,aid"),[end])
+        else:
+            crs.execute(sql.format(src," AND aid=? ORDER BY dt,xid"),[end,aid])
+        while True:
+            rows=crs.fetchmany(EXPORT_BATCH)
+            if not rows:
+                break
+            yield rows
+
+def export_values(row):
+    """turn a transaction row into exported values; comments are stored
+    escaped, and exported as entered"""
+    xid,dt,aid,oaid,dr,cr,bal,comment=row
+    return [xid,date.fromordinal(dt).isoformat(),aid,oaid,
+    int2dec(int(dr)),int2dec(int(cr)),int2dec(int(bal)),None if comment is None else unescape(comment)]
+
+def export_csv(crs,aid):
+    """generate a CSV export, a batch at a time"""
+    buf=io.StringIO()
+    w=csv.writer(buf)
+    w.writerow(EXPORT_FIELDS)
+    for rows in export_batches(crs,aid):
+        w.writerows(map(export_values,rows))
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+def export_json(crs,aid):
+    """generate a newline-delimited JSON export, a batch at a time"""
+    for rows in export_batches(crs,aid):
+        yield "".join(json.dumps(dict(zip(EXPORT_FIELDS,export_values(row))),ensure_ascii=False)+"\n"
+        for row in rows)
+
+def export_columns(crs,aid):
+    """generate a columnar export: blocks of a row count, the integer columns
+    (xid,dt,aid,oaid,dr,cr,bal) as 64-bit little-endian arrays, the byte
+    lengths of the comments (-1 for none) and the UTF-8 comments; a zero
+    count ends the export"""
+    yield COLUMNS_MAGIC
+    for rows in export_batches(crs,aid):
+        cols=list(zip(*rows))
+        comments=[None if c is None else unescape(c).encode() for c in cols[7]]
+        arrays=[array("q",[len(rows)])]+[array("q",map(int,c)) for c in cols[:7]]
+        arrays.append(array("q",[-1 if c is None else len(c) for c in comments]))
+        if sys.byteorder=="big":
+            for a in arrays:
+                a.byteswap()
+        yield b"".join(a.tobytes() for a in arrays)+b"".join(c for c in comments if c)
+    yield array("q",[0]).tobytes()
+
+EXPORTERS={"csv":export_csv,"json":export_json,"columns":export_columns}
+
+def read_array(read,n):
+    """read an array of n 64-bit little-endian integers"""
+    b=read(8*n)
+    if len(b)!=8*n:
+        raise BadInput("Truncated columnar export")
+    a=array("q",b)
+    if sys.byteorder=="big":
+        a.byteswap()
+    return a
+
+def columns_records(read):
+    """generate the records of a columnar export, as imported"""
+    if read(len(COLUMNS_MAGIC))!=COLUMNS_MAGIC:
+        raise BadInput("Not a columnar export")
+    while True:
+        n=read_array(read,1)[0]
+        if n==0:
+            return
+        cols=[read_array(read,n) for _ in range(8)]
+        size=sum(l for l in cols[7] if l>0)
+        blob=read(size)
+        if len(blob)!=size:
+            raise BadInput("Truncated columnar export")
+        pos=0
+        for xid,dt,aid,oaid,dr,cr,bal,l in zip(*cols):
+            yield {"xid":xid,"date":date.fromordinal(dt).isoformat(),"aid":aid,"oaid":oaid,
+            "dr":int2dec(dr),"cr":int2dec(cr),"bal":int2dec(bal),
+            "comment":None if l<0 else blob[pos:pos+l].decode()}
+            pos+=max(l,0)
+
+def open_copy(path,key):
+    """open another database file with the key of the working one"""
+    cnx=sqlite3.connect(path,timeout=BUSY_TIMEOUT,check_same_thread=False)
+    cnx.isolation_level=None
+    if not valid_dbkey(cnx.cursor(),key):
+        cnx.close()
+        raise sqlite3.Error("Bad key")
+    return cnx
+
+def copy_pages(src,dst,progress,name="main"):
+    """copy a database, or an attached one by its schema name, with the online
+    backup API, BACKUP_PAGES pages at a time, pausing between steps; call
+    progress(remaining,total) after each step, return the number of pages"""
+    if not hasattr(src,"backup"):
+        raise sqlite3.Error("Online backup not supported")
+    pages=[0]
+    def step(status,remaining,total):
+        pages[0]=total
+        if progress is not None:
+            progress(remaining,total)
+        time.sleep(BACKUP_PAUSE)
+    src.backup(dst,pages=BACKUP_PAGES,progress=step,name=name)
+    return pages[0]
+
+def backup(crs,path,key,vacuum=False,progress=None):
+    """copy the database to a new file, and its archive beside it, page by page
+    or compacted by VACUUM INTO, outside of any transaction; return the number
+    of pages"""
+    crs.execute("SELECT COUNT(*) FROM pragma_database_list WHERE name='archive'")
+    # the archive after the database: what a close copies into it in between
+    # is left out of the archive until the database is closed as well
+    copies=[("main",path)]+([("archive",path+ARCHIVE_SUFFIX)] if res(crs) else [])
+    if any(os.path.exists(p) for _,p in copies):
+        raise ValueError("File exists")
+    pages=0
+    for name,p in copies:
+        if vacuum:
+            crs.execute("VACUUM {} INTO ?".format(name),[p])
+        dst=open_copy(p,key)
+        try:
+            if vacuum:
+                pages+=res(dst.execute("PRAGMA page_count"))
+            else:
+                pages+=copy_pages(crs.connection,dst,progress,name)
+        finally:
+            dst.close()
+    return pages
+
+def restore(crs,path,key,progress=None):
+    """replace the contents of the database, and of its archive, with a backup,
+    outside of any transaction; bring the schema up to date and move the change markers
+    past both, so that pages are not taken for unchanged, in a new
+    transaction left to the caller; return the number of pages"""
+    if not os.path.exists(path):
+        raise ValueError("File does not exist")
+    crs.execute("SELECT name,val FROM seqs")
+    seqs=crs.fetchall()
+    src=open_copy(path,key)
+    try:
+        pages=copy_pages(src,crs.connection,progress)
+    finally:
+        src.close()
+    # the archive of the backup, if it has one, after the database: the
+    # archive in use holds what the backup archived, and more, left unread
+    if os.path.exists(path+ARCHIVE_SUFFIX):
+        crs.execute("SELECT file FROM pragma_database_list WHERE name='main'")
+        src=open_copy(path+ARCHIVE_SUFFIX,key)
+        try:
+            dst=open_copy(res(crs)+ARCHIVE_SUFFIX,key)
+            try:
+                pages+=copy_pages(src,dst,progress)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+    begin(crs,True)
+    migrate(crs)
+    crs.executemany("UPDATE seqs SET val=MAX(val,?)+? WHERE name=?",
+    [(val,0 if name=="xid" else 1,name) for name,val in seqs])
+    return pages
+
+def backup_dir(crs):
+    """get the directory of the backups made through the web interface"""
+    if BACKUP_DIR is not None:
+        return BACKUP_DIR
+    crs.execute("SELECT file FROM pragma_database_list WHERE name='main'")
+    return os.path.dirname(res(crs))
+
+def backup_page(crs,environ):
+    """back the database up to a new file in the backup directory"""
+    # writing a copy of the database is no answer to a link followed
+    if environ.get("REQUEST_METHOD")!="POST":
+        raise ValueError("Wrong access")
+    qs=environ["wsgi.input"].readline().decode()
+    q=parse_qs(qs)
+    vacuum=q.get("vacuum",["0"])[0]=="1"
+    d=backup_dir(crs)
+    crs.execute("SELECT file FROM pragma_database_list WHERE name='main'")
+    stem="{}-{}".format(os.path.splitext(os.path.basename(res(crs)))[0],time.strftime("%Y%m%d-%H%M%S"))
+    name=stem+".sql"
+    n=0
+    while os.path.exists(os.path.join(d,name)):
+        n+=1
+        name="{}-{}.sql".format(stem,n)
+    crs.connection.commit() # copy outside of the request transaction
+    start=time.monotonic()
+    pages=backup(crs,os.path.join(d,name),environ.get("debs.dbkey"),vacuum)
+    begin(crs)
+    return HTMLResponse("200 OK",[("Content-type","text/plain")],
+    "{} written, {} pages in {:.1f} s\n".format(name,pages,time.monotonic()-start))
+
+def restore_page(crs,environ):
+    """restore the database from a file of the backup directory"""
+    qs=environ["wsgi.input"].readline().decode()
+    q=parse_qs(qs)
+    try:
+        name=q["file"][0]
+    except KeyError as e:
+        raise ValueError("Wrong access") from e
+    if os.path.basename(name)!=name or name.startswith("."):
+        raise ValueError("Bad file")
+    path=os.path.join(backup_dir(crs),name)
+    crs.connection.commit() # copy outside of the request transaction
+    start=time.monotonic()
+    pages=restore(crs,path,environ.get("debs.dbkey"))
+    return HTMLResponse("200 OK",[("Content-type","text/plain")],
+    "{} restored, {} pages in {:.1f} s\n".format(name,pages,time.monotonic()-start))
 
 def del_xact(crs,environ):
     """delete transaction"""
@@ -656,19 +2008,24 @@ def del_xact(crs,environ):
         raise ValueError("Bad xid")
     crs.execute("SELECT oaid FROM xacts WHERE xid=? AND aid=?",[xid,aid])
     oaid=res(crs)
+    if oaid==int(aid):
+        raise ValueError("Bad xid") # an opening balance
     crs.execute("SELECT COUNT(aid) FROM accts WHERE aid=? AND cdt=0",[oaid])
     if res(crs)==0:
         raise ValueError("Bad oaid")
-    crs.execute("SELECT COUNT(*) FROM xacts WHERE xid>? AND aid=?",[xid,aid])
-    if res(crs)!=0:
-        raise ValueError("Current account has newer transactions")
-    crs.execute("SELECT COUNT(*) FROM xacts WHERE xid>? AND aid=?",[xid,oaid])
-    if res(crs)!=0:
-        raise ValueError("Opposing account has newer transactions")
+    environ["debs.stale"]={int(aid),oaid}
     # delete transaction
+    crs.execute("SELECT x.aid,x.dt,x.dr,x.cr,a.type FROM xacts x JOIN accts a ON a.aid=x.aid WHERE x.xid=?",[xid])
+    rows=crs.fetchall()
     crs.execute("DELETE FROM xacts WHERE xid=?",[xid])
+    # shift the running balances of later transactions back,
+    # restore materialized balances and totals
+    start=time.perf_counter()
+    n=sum(shift_later(crs,a,dt,int(xid),-new_balance(atype,0,int(dr),int(cr)))
+    for a,dt,dr,cr,atype in rows)
     # return redirect
-    return HTMLResponse("303 See Other",[("Location","acct?aid={}".format(aid))],"")
+    return HTMLResponse("303 See Other",[("Location","acct?aid={}".format(aid)),
+    repair_timing(start,n)],"")
 
 def creat_acct(crs,environ):
     """create a new account"""
@@ -720,3 +2077,511 @@ def close_acct(crs,environ):
     crs.execute("UPDATE accts SET cdt=? WHERE aid=?",[now,aid])
     # return redirect
     return HTMLResponse("303 See Other",[("Location","acct?aid={}".format(aid))],"")
+
+REPORT_HEAD=fragment("""
+    <div class=center>
+    <h2>{}</h2>
+    </div>
+    <a href=".">Back to list</a>
+    <form class=inline action={} method=get>
+    &nbsp; {}
+    <input type=submit value=Show>
+    </form>
+    <hr>
+    <table class=center>
+    """)
+REPORT_DATE=fragment("""
+    {} <input type=text name={} size=10 maxlength=10 class=w12 value="{}">
+    """)
+REPORT_YEAR=fragment("""
+    Year <input type=text name=year size=4 maxlength=4 class=w4 value="{}">
+    """)
+REPORT_COLS=fragment("""
+    <tr class=line><th>Account</th>{}</tr>
+    """)
+REPORT_COL=fragment("""
+    <th class=r>{}</th>
+    """)
+REPORT_ROW=fragment("""
+    <tr class="line {}"><td>{}</td>{}</tr>
+    """)
+REPORT_CELL=fragment("""
+    <td class=r>&nbsp; {}</td>
+    """)
+REPORT_ACCT=fragment("""
+    <span class=atype>{}</span>&nbsp;<a href="acct?aid={}">{}</a>
+    """)
+REPORT_END=fragment("""
+    </table>
+    """)
+
+def balance_asof(crs,aid,dt):
+    """return the last transaction id of account aid at the end of day dt
+    and the balance after it, or (None,0) if there are none"""
+    crs.execute("SELECT xid,bal FROM xacts WHERE aid=? AND dt<=? ORDER BY dt DESC,xid DESC LIMIT 1",[aid,dt])
+    r=crs.fetchone()
+    # days before the opening balances are found in the archive
+    if r is None and dt<period(crs)-1:
+        crs.execute("SELECT xid,bal FROM archive.xacts WHERE aid=? AND dt<=? ORDER BY dt DESC,xid DESC LIMIT 1",[aid,dt])
+        r=crs.fetchone()
+    if r is not None:
+        return r[0],int(r[1])
+    return None,0
+
+def balances_asof(crs,dt):
+    """return the balances of all accounts at the end of day dt as a dictionary"""
+    src="archive.xacts" if dt<period(crs)-1 else "xacts"
+    crs.execute("""SELECT aid,(SELECT bal FROM {} WHERE aid=accts.aid AND dt<=?
+    ORDER BY dt DESC,xid DESC LIMIT 1) FROM accts""".format(src),[dt])
+    return {aid:int(bal) if bal is not None else 0 for aid,bal in crs}
+
+def period(crs):
+    """return the first day of the open period, or 0 if none was closed"""
+    crs.execute("SELECT closed FROM period")
+    return res(crs)
+
+def check_cutoff(crs,cutoff):
+    """check that the period before day cutoff can be closed, return the first
+    day of the open period"""
+    closed=period(crs)
+    if cutoff<=closed:
+        raise ValueError("Period already closed")
+    # the open period includes today
+    if cutoff>date.today().toordinal()+1:
+        raise ValueError("Cannot close a period not yet over")
+    return closed
+
+# the transactions of the open period dated before a cutoff, except the
+# opening balances of an earlier close, which are not archived
+CLOSING="SELECT * FROM xacts WHERE dt<? AND aid!=oaid"
+
+def archive_period(crs,cutoff):
+    """copy the transactions dated before day cutoff into the attached archive,
+    replacing what an interrupted close copied there"""
+    closed=check_cutoff(crs,cutoff)
+    crs.execute("DELETE FROM archive.xacts WHERE dt>=?",[closed])
+    crs.execute("INSERT OR IGNORE INTO archive.xacts "+CLOSING,[cutoff])
+
+def close_period(crs,cutoff):
+    """remove the transactions dated before day cutoff, copied by archive_period,
+    opening each of their accounts with its balance at the end of the day before;
+    return the number of transactions archived, or None if some changed since
+    they were copied"""
+    closed=check_cutoff(crs,cutoff)
+    crs.execute("""SELECT EXISTS({0} EXCEPT {1}) OR EXISTS({1} EXCEPT {0})""".format(
+    CLOSING,"SELECT * FROM archive.xacts WHERE dt>=?"),[cutoff,closed,closed,cutoff])
+    if res(crs):
+        return None
+    crs.execute("UPDATE period SET closed=?",[cutoff])
+    crs.execute("""SELECT aid,(SELECT bal FROM xacts WHERE aid=a.aid AND dt<?
+    ORDER BY dt DESC,xid DESC LIMIT 1) FROM (SELECT DISTINCT aid FROM xacts WHERE dt<?) a""",[cutoff,cutoff])
+    opening=crs.fetchall()
+    crs.execute("DELETE FROM xacts WHERE dt<? AND aid=oaid",[cutoff])
+    crs.execute("DELETE FROM xacts WHERE dt<?",[cutoff])
+    n=crs.rowcount//2
+    # the opening balances share a transaction id and keep the running
+    # balances, the materialized ones and the totals as they are
+    if opening:
+        xid=next_xid(crs)
+        crs.executemany("INSERT INTO xacts VALUES(?,?,?,?,0,0,?,?)",
+        [(xid,cutoff-1,aid,aid,bal,OPENING_COMMENT) for aid,bal in opening])
+        for aid,_ in opening:
+            refresh_balance(crs,aid)
+    return n
+
+def report_accts(crs,atypes):
+    """return (aid,type,name) of the accounts of given types in the order of ATYPES"""
+    d=directory(crs)
+    accts=[(aid,)+d.accts[aid][:2] for aid in d.names]
+    return [a for atc,_ in ATYPES if atc in atypes for a in accts if a[1]==atc]
+
+def get_date(q,name,default):
+    """get a YYYY-MM-DD date argument as an ordinal"""
+    try:
+        return date.fromisoformat(q[name][0]).toordinal()
+    except KeyError:
+        return default
+    except ValueError as e:
+        raise BadInput("Bad date") from e
+
+def report_page(title,action,form,cols,rows):
+    """render a report table; rows are (class,account label,cells)"""
+    b=[HEAD,REPORT_HEAD.format(title,action,form),
+    REPORT_COLS.format("".join(REPORT_COL.format(c) for c in cols))]
+    for cls,label,cells in rows:
+        b.append(REPORT_ROW.format(cls,label,"".join(
+        REPORT_CELL.format(int2cur(v) if v else "") for v in cells)))
+    b.append(REPORT_END)
+    b.append(CELLAR)
+    return HTMLResponse("200 OK",[("Content-type","text/html")],"".join(b))
+
+def trial_bal(crs,qs):
+    """show trial balance as of a date"""
+    q=parse_qs(qs)
+    dt=get_date(q,"dt",date.today().toordinal())
+    bals=balances_asof(crs,dt)
+    rows=[]
+    totdr=totcr=0
+    for aid,atype,name in report_accts(crs,"EALie"):
+        bal=bals[aid]
+        if bal==0:
+            continue
+        # put the balance on its normal side, or on the other one if negative
+        if (atype in ("A","e"))==(bal>0):
+            dr,cr=abs(bal),0
+        else:
+            dr,cr=0,abs(bal)
+        totdr+=dr
+        totcr+=cr
+        rows.append(("",REPORT_ACCT.format(atype,aid,name),[dr,cr]))
+    rows.append(("sep_tot","Total",[totdr,totcr]))
+    form=REPORT_DATE.format("As of","dt",date.fromordinal(dt))
+    return report_page("Trial balance","trial_bal",form,["Dr","Cr"],rows)
+
+def income_stmt(crs,qs):
+    """show income statement for a date range"""
+    q=parse_qs(qs)
+    today=date.today()
+    dt1=get_date(q,"from",date(today.year,1,1).toordinal())
+    dt2=get_date(q,"to",today.toordinal())
+    if dt1>dt2:
+        raise BadInput("Empty date range")
+    # the change of each balance over the range
+    bals1=balances_asof(crs,dt1-1)
+    bals2=balances_asof(crs,dt2)
+    rows=[]
+    net=0
+    for atc,atn in ATYPES:
+        if atc not in ("i","e"):
+            continue
+        tot=0
+        for aid,atype,name in report_accts(crs,atc):
+            d=bals2[aid]-bals1[aid]
+            if d!=0:
+                tot+=d
+                rows.append(("",REPORT_ACCT.format(atype,aid,name),[d]))
+        rows.append(("sep_tot","Total {}".format(atn.lower()),[tot]))
+        net+=tot if atc=="i" else -tot
+    rows.append(("sep_year","Net income",[net]))
+    form=REPORT_DATE.format("From","from",date.fromordinal(dt1))+REPORT_DATE.format("to","to",date.fromordinal(dt2))
+    return report_page("Income statement","income_stmt",form,["Amount"],rows)
+
+def monthly(crs,qs):
+    """show monthly changes of account balances over a year"""
+    q=parse_qs(qs)
+    try:
+        year=int(q.get("year",[date.today().year])[0])
+        ends=[date(year,1,1).toordinal()-1]+[date(year+m//12,m%12+1,1).toordinal()-1 for m in range(1,13)]
+    except ValueError as e:
+        raise BadInput("Bad year") from e
+    # balances at the end of the previous year and of every month
+    bals=[balances_asof(crs,dt) for dt in ends]
+    rows=[]
+    for aid,atype,name in report_accts(crs,"EALie"):
+        cells=[bals[m][aid]-bals[m-1][aid] for m in range(1,13)]
+        if any(cells):
+            rows.append(("",REPORT_ACCT.format(atype,aid,name),cells+[bals[12][aid]-bals[0][aid]]))
+    form=REPORT_YEAR.format(year)
+    cols=[date(year,m,1).strftime("%b") for m in range(1,13)]+["Total"]
+    return report_page("Monthly changes","monthly",form,cols,rows)
+
+SEARCH_FORM=fragment("""
+    Text <input type=search name=q value="{}">
+    &nbsp; Account <select name=aid>
+    <option value="">All</option>
+    {}
+    </select>
+    """)
+SEARCH_OPTION=fragment("""
+    <option value="{}"{}>{}</option>
+    """)
+SEARCH_COLS=fragment("""
+    <tr class=line><th>Date</th><th>Account</th><th>Opposing account</th>
+    <th class=r>Dr</th><th class=r>Cr</th><th>Comment</th></tr>
+    """)
+SEARCH_ROW=fragment("""
+    <tr class=line>
+    <td class=date>{}</td>
+    <td><a href="acct?aid={}">{}</a></td>
+    <td><a href="acct?aid={}">{}</a></td>
+    <td class=r>&nbsp; {}</td>
+    <td class=r>&nbsp; {}</td>
+    <td class=comm>&nbsp;<small>{}</small></td>
+    </tr>
+    """)
+SEARCH_OLDER=fragment("""
+    <div class=center>
+    <a href="search?{}">Older</a>
+    </div>
+    """)
+
+# a comment as typed: comments are stored escaped by html.escape()
+UNESCAPED="""replace(replace(replace(replace(replace({},
+'&lt;','<'),'&gt;','>'),'&quot;','"'),'&#x27;',''''),'&amp;','&')"""
+
+def create_search(crs):
+    """create, or create again, the full-text index of comments, with one
+    entry per transaction, and the triggers keeping it in step with the
+    transactions; return False if SQLite lacks FTS5"""
+    for op in ("insert","delete","update"):
+        crs.execute("DROP TRIGGER IF EXISTS comments_{}".format(op))
+    crs.execute("DROP TABLE IF EXISTS comments")
+    try:
+        crs.execute("CREATE VIRTUAL TABLE comments USING fts5(comment)")
+    except sqlite3.OperationalError as e:
+        if "fts5" not in str(e):
+            raise
+        return False
+    crs.execute("""CREATE TRIGGER comments_insert AFTER INSERT ON xacts WHEN NEW.aid<NEW.oaid
+    BEGIN INSERT INTO comments(rowid,comment) VALUES(NEW.xid,{}); END""".format(UNESCAPED.format("NEW.comment")))
+    crs.execute("""CREATE TRIGGER comments_delete AFTER DELETE ON xacts WHEN OLD.aid<OLD.oaid
+    BEGIN DELETE FROM comments WHERE rowid=OLD.xid; END""")
+    crs.execute("""CREATE TRIGGER comments_update AFTER UPDATE OF comment ON xacts WHEN NEW.aid<NEW.oaid
+    BEGIN UPDATE comments SET comment={} WHERE rowid=NEW.xid; END""".format(UNESCAPED.format("NEW.comment")))
+    crs.execute("INSERT INTO comments(rowid,comment) SELECT xid,{} FROM xacts WHERE aid<oaid".format(
+    UNESCAPED.format("comment")))
+    return True
+
+def fts_query(text):
+    """turn search text into an FTS5 query matching all of its words,
+    a word ending with * matching as a prefix"""
+    terms=[]
+    for t in text.split():
+        prefix="*" if t.endswith("*") else ""
+        t=t.rstrip("*")
+        if t:
+            terms.append('"{}"{}'.format(t.replace('"','""'),prefix))
+    return " ".join(terms)
+
+def search_xacts(crs,text,aid=None,dt1=None,dt2=None,before=None,limit=LIMIT):
+    """find transactions whose comments match search text, newest first, as
+    rows (xid,dt,aid,oaid,dr,cr,bal,comment,name,oname) of account aid, or
+    one row per transaction"""
+    match=fts_query(text)
+    if not match:
+        return []
+    sql=["""SELECT x.xid,x.dt,x.aid,x.oaid,x.dr,x.cr,x.bal,x.comment,a.name,o.name
+    FROM comments c JOIN xacts x ON x.xid=c.rowid JOIN accts a ON a.aid=x.aid JOIN accts o ON o.aid=x.oaid
+    WHERE comments MATCH ?"""]
+    args=[match]
+    if aid is None:
+        sql.append("AND x.aid<x.oaid")
+    else:
+        sql.append("AND x.aid=?")
+        args.append(aid)
+    for cond,v in (("c.rowid<?",before),("x.dt>=?",dt1),("x.dt<=?",dt2)):
+        if v is not None:
+            sql.append("AND "+cond)
+            args.append(v)
+    sql.append("ORDER BY c.rowid DESC LIMIT ?")
+    args.append(limit)
+    try:
+        crs.execute(" ".join(sql),args)
+    except sqlite3.OperationalError as e:
+        if "no such table" in str(e):
+            raise BadInput("Search not available") from e
+        raise
+    return crs.fetchall()
+
+def search(crs,qs):
+    """show the transactions whose comments match a search, or list them
+    as newline-delimited JSON"""
+    q=parse_qs(qs or "")
+    text=q.get("q",[""])[0]
+    dt1=get_date(q,"from",None)
+    dt2=get_date(q,"to",None)
+    try:
+        aid=db_int(q["aid"][0]) if q.get("aid",[""])[0] else None
+        before=db_int(q["before_xid"][0]) if "before_xid" in q else None
+    except ValueError as e:
+        raise BadInput("Bad argument") from e
+    rows=search_xacts(crs,text,aid,dt1,dt2,before,LIMIT+1)
+    if q.get("fmt",[""])[0]=="json":
+        return HTMLResponse("200 OK",[("Content-type","application/x-ndjson")],
+        "".join(json.dumps(dict(zip(EXPORT_FIELDS,export_values(row[:8]))),ensure_ascii=False)+"\n"
+        for row in rows[:LIMIT]))
+    options="".join(SEARCH_OPTION.format(a," selected" if a==aid else "",name)
+    for a,_,name in report_accts(crs,"EALie"))
+    form=(SEARCH_FORM.format(escape(text),options)+
+    REPORT_DATE.format("From","from",date.fromordinal(dt1) if dt1 else "")+
+    REPORT_DATE.format("To","to",date.fromordinal(dt2) if dt2 else ""))
+    b=[HEAD,REPORT_HEAD.format("Search","search",form),SEARCH_COLS]
+    for xid,dt,aid_,oaid,dr,cr,bal,comment,name,oname in rows[:LIMIT]:
+        b.append(SEARCH_ROW.format(date.fromordinal(dt),aid_,name,oaid,oname,
+        int2cur(int(dr)) if int(dr) else "",int2cur(int(cr)) if int(cr) else "",comment))
+    b.append(REPORT_END)
+    if len(rows)>LIMIT:
+        q["before_xid"]=[rows[LIMIT-1][0]]
+        b.append(SEARCH_OLDER.format(escape(urlencode(q,doseq=True))))
+    b.append(CELLAR)
+    return HTMLResponse("200 OK",[("Content-type","text/html")],"".join(b))
+
+def cmd_reindex(crs,args):
+    """rebuild the full-text index of comments"""
+    if not create_search(crs):
+        print("Full-text search not available: SQLite lacks FTS5",file=sys.stderr)
+        return 1
+    crs.execute("SELECT COUNT(*) FROM comments")
+    print("{} comment(s) indexed".format(res(crs)))
+    return 0
+
+def cmd_verify(crs,args):
+    """rebuild materialized balances and report discrepancies"""
+    wrong=verify_balances(crs)
+    for aid,stored,actual in wrong:
+        print("aid {}: stored {}, actual {}".format(aid,stored,actual))
+    wrong_totals=rebuild_totals(crs)
+    for atc,stored,actual in wrong_totals:
+        print("type {}: stored {}, actual {}".format(atc,stored,actual))
+    print("{} account(s), {} type total(s) repaired".format(len(wrong),len(wrong_totals)))
+    return 1 if wrong or wrong_totals else 0
+
+def cmd_audit(crs,args):
+    """check every transaction and report discrepancies"""
+    n=0
+    for line in audit(crs):
+        print(line,end="")
+        n+=1
+    return 1 if n>1 else 0
+
+def file_format(name):
+    """guess the import or export format of a file by its extension"""
+    for fmt,(_,ext) in EXPORTS.items():
+        if name.endswith("."+ext):
+            return fmt
+    return "json" if name.endswith(".json") else "csv"
+
+def cmd_import(crs,args):
+    """insert transactions from a CSV, newline-delimited JSON or columnar file"""
+    fmt=args.format or file_format(args.file)
+    if fmt=="columns":
+        if args.file=="-":
+            count,errors=import_xacts(crs,sys.stdin.buffer.read,fmt)
+        else:
+            with open(args.file,"rb") as f:
+                count,errors=import_xacts(crs,f.read,fmt)
+    elif args.file=="-":
+        count,errors=import_xacts(crs,sys.stdin,fmt)
+    else:
+        with open(args.file,newline="",encoding="utf-8") as f:
+            count,errors=import_xacts(crs,f,fmt)
+    print(import_report(count,errors),end="")
+    return 1 if errors else 0
+
+def progress_bar(remaining,total):
+    """show the progress of a backup or restore"""
+    print("\r{} of {} pages".format(total-remaining,total),end="" if remaining else "\n",file=sys.stderr)
+
+def cmd_backup(crs,args):
+    """copy the database to a new file while it is in use"""
+    pages=backup(crs,args.file,args.dbkey,args.vacuum,progress_bar)
+    print("{} written, {} pages".format(args.file,pages))
+    return 0
+
+def cmd_restore(crs,args):
+    """replace the contents of the database with a backup"""
+    pages=restore(crs,args.file,args.dbkey,progress_bar)
+    crs.connection.commit()
+    print("{} restored, {} pages".format(args.file,pages))
+    return 0
+
+def cmd_export(crs,args):
+    """write the transactions of an account, or all of them, to a file"""
+    fmt=args.format or file_format(args.file)
+    if args.aid is not None:
+        crs.execute("SELECT COUNT(*) FROM accts WHERE aid=?",[args.aid])
+        if res(crs)==0:
+            raise ValueError("Bad aid")
+    check_export(crs,fmt,args.aid)
+    out=sys.stdout.buffer if args.file=="-" else open(args.file,"wb")
+    try:
+        for s in EXPORTERS[fmt](crs,args.aid):
+            out.write(s.encode() if isinstance(s,str) else s)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    return 0
+
+def cmd_close(crs,args):
+    """archive the transactions dated before a day"""
+    try:
+        cutoff=date.fromisoformat(args.date).toordinal()
+    except ValueError as e:
+        raise BadInput("Bad date") from e
+    attach_archive(crs.connection,args.db,True)
+    # the archive and the database are committed apart, as a transaction
+    # across both is not atomic in WAL mode: the copy is committed first and
+    # made again if a transaction changed before the cutoff in between
+    n=None
+    while n is None:
+        begin(crs,True)
+        with crs.connection:
+            archive_period(crs,cutoff)
+        begin(crs,True)
+        with crs.connection:
+            n=close_period(crs,cutoff)
+    print("{} transactions archived".format(n))
+    return 0
+
+def cli(argv):
+    """command-line entry point"""
+    ap=argparse.ArgumentParser(prog="debs",description="Double-entry Bookkeeping System")
+    ap.add_argument("--db",default=os.environ.get("DB"),
+    help="database file (default: $DB)")
+    ap.add_argument("--dbkey",default=os.environ.get("DBKEY"),
+    help="raw SQLCipher key (default: $DBKEY)")
+    sub=ap.add_subparsers(dest="cmd",required=True)
+    sub.add_parser("verify",help=cmd_verify.__doc__).set_defaults(func=cmd_verify,write=True)
+    sub.add_parser("audit",help=cmd_audit.__doc__).set_defaults(func=cmd_audit,write=False)
+    sub.add_parser("reindex",help=cmd_reindex.__doc__).set_defaults(func=cmd_reindex,write=True)
+    sp=sub.add_parser("import",help=cmd_import.__doc__)
+    sp.add_argument("file",help="input file, - for standard input")
+    sp.add_argument("--format",choices=list(EXPORTS),
+    help="input format (default: by file extension)")
+    sp.set_defaults(func=cmd_import,write=True)
+    sp=sub.add_parser("export",help=cmd_export.__doc__)
+    sp.add_argument("file",help="output file, - for standard output")
+    sp.add_argument("--aid",type=int,help="account to export (default: all)")
+    sp.add_argument("--format",choices=list(EXPORTS),
+    help="output format (default: by file extension)")
+    sp.set_defaults(func=cmd_export,write=False)
+    sp=sub.add_parser("backup",help=cmd_backup.__doc__)
+    sp.add_argument("file",help="backup file to create")
+    sp.add_argument("--vacuum",action="store_true",
+    help="write a compacted copy with VACUUM INTO instead of copying pages")
+    sp.set_defaults(func=cmd_backup,write=None)
+    sp=sub.add_parser("restore",help=cmd_restore.__doc__)
+    sp.add_argument("file",help="backup file to restore")
+    sp.set_defaults(func=cmd_restore,write=None)
+    sp=sub.add_parser("close",help=cmd_close.__doc__)
+    sp.add_argument("date",help="first day left open, YYYY-MM-DD")
+    sp.set_defaults(func=cmd_close,write=None)
+    args=ap.parse_args(argv)
+    if args.db is None:
+        ap.error("no database file given")
+    try:
+        if not os.path.exists(args.db):
+            raise sqlite3.Error("File does not exist")
+        cnx=connect(args.db,args.dbkey)
+        if cnx is None:
+            raise sqlite3.Error("Bad key")
+        try:
+            attach_archive(cnx,args.db)
+            crs=cnx.cursor()
+            # backups and restores run outside of a transaction
+            if args.write is None:
+                return args.func(crs,args)
+            begin(crs,args.write)
+            with cnx:
+                return args.func(crs,args)
+        finally:
+            cnx.close()
+    except sqlite3.Error as e:
+        print("Database error: {}".format(e),file=sys.stderr)
+        return 2
+    except (ValueError,BadInput) as e:
+        print("Error: {}".format(e),file=sys.stderr)
+        return 2
+
+if __name__=="__main__":
+    sys.exit(cli(sys.argv[1:]))
@@ -0,0 +1,69 @@
+"""
+Shared fixtures: a fresh copy of the empty database and a request helper
+"""
+
+import io
+import os
+import re
+import shutil
+import sys
+from datetime import date
+from urllib.parse import urlencode
+
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import debs
+
+ACCTS=[("E","Capital"),("A","Cash"),("A","Bank"),("e","Food"),("i","Salary"),("L","Loan")]
+
+class App:
+    """the application on a database file"""
+
+    def __init__(self,db):
+        self.db=db
+
+    def req(self,path,qs="",post=None,headers=None):
+        """call the application, return (status,headers,body)"""
+        environ={"PATH_INFO":path,"QUERY_STRING":qs,"REQUEST_METHOD":"GET" if post is None else "POST",
+        "wsgi.input":io.BytesIO((post or "").encode()),"wsgi.errors":sys.stderr}
+        environ.update(headers or {})
+        out=[]
+        body=b"".join(debs.application(environ,lambda s,h: out.append((s,h))))
+        return out[0][0],out[0][1],body
+
+    def ins(self,aid,oaid,dt,dr="",cr="",newbal="",comment="x"):
+        """insert a transaction dated by an ordinal, return the status"""
+        d=date.fromordinal(dt)
+        return self.req("/ins_xact",post="yyyy={}&mm={}&dd={}&dr={}&cr={}&newbal={}&aid={}&oaid={}&comment={}".format(
+        d.year,d.month,d.day,dr,cr,newbal,aid,oaid,comment))[0]
+
+    def submit(self,page,**values):
+        """fill in the form of a report page with values and submit it"""
+        m=re.search(rb'<form class=inline action=(\w+) method=get>(.*?)</form>',page,re.S)
+        assert m is not None
+        fields={name.decode():value.decode() for name,value in re.findall(rb'name=(\w+)[^>]*value="([^"]*)"',m.group(2))}
+        assert set(values)<=set(fields)
+        fields.update(values)
+        return self.req("/"+m.group(1).decode(),urlencode(fields))
+
+    def cursor(self):
+        """a cursor on a connection of its own"""
+        return debs.connect(self.db,None).cursor()
+
+@pytest.fixture
+def app(tmp_path,monkeypatch):
+    """an empty database with the accounts of ACCTS, opened a thousand days ago"""
+    db=str(tmp_path/"debs.sql")
+    shutil.copy(os.path.join(os.path.dirname(debs.__file__),"debs.sql"),db)
+    monkeypatch.setenv("DB",db)
+    a=App(db)
+    for atype,name in ACCTS:
+        assert a.req("/creat_acct",post="atype={}&aname={}".format(atype,name))[0].startswith("303")
+    crs=a.cursor()
+    crs.execute("UPDATE accts SET odt=odt-1000")
+    crs.connection.close()
+    yield a
+    debs.pool_evict(db)
+    with debs.PAGES_LOCK:
+        debs.pages_drop(db,lambda aid: True)
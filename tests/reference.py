@@ -0,0 +1,32 @@
+"""
+Reference amount conversions, kept from before their optimization
+"""
+
+from debs import DECIMAL_SEP,THOUSAND_SEP
+
+def cur2int(s):
+    """convert currency string to integer"""
+    s=s.replace(" ","") # drop spaces
+    s=s.replace(",",DECIMAL_SEP) # always accept "," as a decimal separator
+    s=s.replace(".",DECIMAL_SEP) # always accept "." as a decimal separator
+    r=""
+    i=0
+    for i,c in enumerate(s):
+        if c is DECIMAL_SEP:
+            break
+        r=r+c
+    return int(r+s[i+1:i+3].ljust(2,"0"))
+
+def int2cur(v):
+    """convert integer to currency string"""
+    s=str(abs(v))
+    r=""
+    for i,c in enumerate(s[::-1].ljust(3,"0"),1):
+        if i==3:
+            r=DECIMAL_SEP+r
+        elif i%3==0:
+            r=THOUSAND_SEP+r
+        r=c+r
+    if v<0:
+        r="&minus;"+r
+    return r
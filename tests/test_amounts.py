@@ -0,0 +1,42 @@
+"""
+Amount formatting and parsing against the reference implementations
+"""
+
+import random
+
+import pytest
+
+import debs
+import reference
+
+def outcome(f,x):
+    """the result of f(x), or the type of the exception raised"""
+    try:
+        return f(x)
+    except Exception as e:
+        return type(e)
+
+def random_amount(rnd):
+    """an amount as typed in the form, well-formed or not"""
+    return "".join(rnd.choice("0123456789"*4+" ,.-+x") for _ in range(rnd.randrange(12)))
+
+@pytest.mark.parametrize("seed",range(20))
+def test_cur2int(seed):
+    rnd=random.Random(seed)
+    for _ in range(2000):
+        s=random_amount(rnd)
+        assert outcome(debs.cur2int,s)==outcome(reference.cur2int,s),s
+
+@pytest.mark.parametrize("seed",range(20))
+def test_int2cur(seed):
+    rnd=random.Random(seed)
+    for _ in range(2000):
+        v=rnd.randrange(-10**rnd.randrange(1,40),10**rnd.randrange(1,40))
+        assert debs.int2cur(v)==reference.int2cur(v),v
+
+def test_edges():
+    for v in (0,1,-1,99,100,-100,999,1000,10**5,-10**5,2**63,-2**63):
+        assert debs.int2cur(v)==reference.int2cur(v)
+        assert debs.cur2int(reference.int2cur(v).replace("&minus;","-"))==v
+    for s in ("","0","1,","1,5","1.55","1 000,5",",5","-1,5","12,345"):
+        assert debs.cur2int(s)==reference.cur2int(s)
@@ -0,0 +1,69 @@
+"""
+Back-dated inserts and deletes against a full recompute of the balances
+"""
+
+import random
+from datetime import date
+
+import debs
+
+def recompute(crs):
+    """check every running balance, acct_bals and type_totals against
+    balances recomputed in (dt,xid) order"""
+    crs.execute("SELECT aid,type FROM accts")
+    types=dict(crs.fetchall())
+    totals={atc:0 for atc,_ in debs.ATYPES}
+    last={}
+    for aid,atype in types.items():
+        bal=0
+        crs.execute("SELECT xid,dr,cr,bal FROM xacts WHERE aid=? ORDER BY dt,xid",[aid])
+        for xid,dr,cr,x_bal in crs.fetchall():
+            bal=debs.new_balance(atype,bal,int(dr),int(cr))
+            assert int(x_bal)==bal,(aid,xid)
+            last[aid]=(xid,bal)
+        totals[atype]+=bal
+    crs.execute("SELECT aid,xid,bal FROM acct_bals")
+    assert {aid:(xid,int(bal)) for aid,xid,bal in crs.fetchall()}==last
+    crs.execute("SELECT type,total FROM type_totals")
+    assert {atc:int(total) for atc,total in crs.fetchall()}==totals
+
+def test_random_backdated(app):
+    rnd=random.Random(22)
+    today=date.today().toordinal()
+    crs=app.cursor()
+    for i in range(300):
+        crs.execute("SELECT xid,aid FROM xacts WHERE aid<oaid")
+        xacts=crs.fetchall()
+        if xacts and rnd.random()<0.3:
+            xid,aid=rnd.choice(xacts)
+            assert app.req("/del_xact",post="xid={}&aid={}".format(xid,aid))[0]=="303 See Other"
+            continue
+        aid,oaid=rnd.sample(range(1,7),2)
+        dt=today-rnd.randrange(500)
+        if rnd.random()<0.1:
+            # zero amount: the balance stays as it is on the day
+            bal=debs.balance_asof(crs,aid,dt)[1]
+            crs.connection.rollback()
+            status=app.ins(aid,oaid,dt,newbal="{}{}.{:02}".format("-" if bal<0 else "",abs(bal)//100,abs(bal)%100))
+        elif rnd.random()<0.05:
+            status=app.ins(aid,oaid,dt,dr="9"*25)
+        else:
+            status=app.ins(aid,oaid,dt,dr="{},{:02}".format(rnd.randrange(1,10**6),rnd.randrange(100)))
+        assert status=="303 See Other"
+        if i%50==0:
+            recompute(crs)
+            crs.connection.rollback()
+    recompute(crs)
+    assert list(debs.audit(crs))==["0 discrepancies\n"]
+
+def test_zero_amount_keeps_last_transaction(app):
+    today=date.today().toordinal()
+    assert app.ins(2,1,today,dr="100")=="303 See Other"
+    assert app.ins(2,3,today,newbal="100")=="303 See Other"
+    crs=app.cursor()
+    recompute(crs)
+    crs.execute("SELECT xid FROM xacts WHERE aid=2 AND dr=0 AND cr=0")
+    xid=crs.fetchone()[0]
+    crs.connection.rollback()
+    assert app.req("/del_xact",post="xid={}&aid=2".format(xid))[0]=="303 See Other"
+    recompute(crs)
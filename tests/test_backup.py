@@ -0,0 +1,24 @@
+"""
+Backups made and restored through the web interface
+"""
+
+import os
+import re
+from datetime import date
+
+def test_backup_is_posted(app):
+    today=date.today().toordinal()
+    assert app.ins(2,1,today,dr="1")=="303 See Other"
+    d=os.path.dirname(app.db)
+    files=set(os.listdir(d))
+    for qs in ("","vacuum=1"):
+        assert app.req("/backup",qs)[0]=="400 Bad Request"
+    assert set(os.listdir(d))==files
+    status,_,body=app.req("/backup",post="vacuum=1")
+    assert status=="200 OK"
+    name=re.match(rb"(\S+) written",body).group(1).decode()
+    assert set(os.listdir(d))-files=={name}
+    assert app.ins(2,1,today,dr="2")=="303 See Other"
+    assert app.req("/restore",post="file="+name)[0]=="200 OK"
+    assert b"1,00" in app.req("/acct","aid=2")[2]
+    assert b"3,00" not in app.req("/acct","aid=2")[2]
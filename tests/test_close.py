@@ -0,0 +1,140 @@
+"""
+Closing a period into the archive
+"""
+
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+from datetime import date
+
+import debs
+
+def run(db,*args):
+    """run a command on a database, return (exit status,output)"""
+    debs.pool_evict(db)
+    r=subprocess.run([sys.executable,debs.__file__,"--db",db]+list(args),capture_output=True,text=True)
+    return r.returncode,r.stdout+r.stderr
+
+def close(app,day):
+    """run the close command, return (exit status,output)"""
+    return run(app.db,"close",date.fromordinal(day).isoformat())
+
+def test_close(app):
+    today=date.today().toordinal()
+    for i in range(20):
+        assert app.ins(2,1,today-200+i*10,dr=str(i+1))=="303 See Other"
+    trial=app.req("/trial_bal","dt={}".format(date.fromordinal(today-150)))[2]
+    assert b"21,00" in trial and date.fromordinal(today-150).isoformat().encode() in trial
+    assert close(app,today-100)==(0,"10 transactions archived\n")
+    assert app.req("/trial_bal","dt={}".format(date.fromordinal(today-150)))[2]==trial
+    assert app.ins(2,1,today-101,dr="1")=="400 Bad Request"
+    assert app.ins(2,1,today-100,dr="1")=="303 See Other"
+    assert list(debs.audit(app.cursor()))==["0 discrepancies\n"]
+
+def test_close_rejects_future(app):
+    today=date.today().toordinal()
+    assert app.ins(2,1,today,dr="1")=="303 See Other"
+    status,out=close(app,today+2)
+    assert status==2 and "not yet over" in out
+    assert close(app,today+1)==(0,"1 transactions archived\n")
+
+def test_paging_across_close(app,monkeypatch):
+    monkeypatch.setattr(debs,"LIMIT",4)
+    monkeypatch.setattr(debs,"PAGE_CACHE_SIZE",0)
+    today=date.today().toordinal()
+    for i in range(19):
+        assert app.ins(2,1,today-190+i*10,dr=str(i+1))=="303 See Other"
+    def walk(link):
+        """dates and balances of every page reached through a link, and the pages"""
+        rows=[]
+        pages=[]
+        qs="aid=2"
+        while True:
+            body=app.req("/acct",qs)[2]
+            pages.append(body)
+            rows+=re.findall(rb"<td class=date>([-\d]+)</td>.*?<td class=bal>(.*?)</td>",body,re.S)
+            m=re.search(rb'before_xid=(\d+)">'+link,body)
+            if m is None:
+                return rows,pages
+            qs="aid=2&before_xid="+m.group(1).decode()
+    before,_=walk(b"Older")
+    assert close(app,today-95)==(0,"10 transactions archived\n")
+    after,pages=walk(b"Older")
+    opening=(date.fromordinal(today-96).isoformat().encode(),before[9][1])
+    assert after==before[:9]+[opening]+before[9:]
+    # the oldest page and the way back
+    m=re.search(rb'before_xid=(\d+)">Oldest',pages[0])
+    oldest=app.req("/acct","aid=2&before_xid="+m.group(1).decode())[2]
+    assert re.findall(rb"<td class=date>([-\d]+)</td>",oldest)==[d for d,_ in before[-4:]]
+    m=re.search(rb'before_xid=(\d+)">Newer',oldest)
+    newer=app.req("/acct","aid=2&before_xid="+m.group(1).decode())[2]
+    assert re.findall(rb"<td class=date>([-\d]+)</td>",newer)==[d for d,_ in after[-8:-4]]
+
+def test_interrupted_close(app,monkeypatch):
+    monkeypatch.setattr(debs,"PAGE_CACHE_SIZE",0)
+    today=date.today().toordinal()
+    for i in range(10):
+        assert app.ins(2,1,today-200+i*10,dr=str(i+1))=="303 See Other"
+    assert close(app,today-175)==(0,"3 transactions archived\n")
+    page=app.req("/acct","aid=2")[2]
+    # the copy into the archive was committed, the removal was not
+    debs.pool_evict(app.db)
+    crs=app.cursor()
+    debs.attach_archive(crs.connection,app.db,True)
+    debs.begin(crs,True)
+    with crs.connection:
+        debs.archive_period(crs,today-130)
+    crs.execute("SELECT xid FROM xacts WHERE aid=2 AND dt=?",[today-150])
+    xid=debs.res(crs)
+    crs.connection.close()
+    assert app.req("/acct","aid=2")[2]==page
+    # the open period changes before the close is run again
+    assert app.req("/del_xact",post="xid={}&aid=2".format(xid))[0]=="303 See Other"
+    assert app.ins(2,1,today-135,dr="11")=="303 See Other"
+    assert close(app,today-130)==(0,"4 transactions archived\n")
+    crs=app.cursor()
+    debs.attach_archive(crs.connection,app.db)
+    crs.execute("SELECT COUNT(*),SUM(xid=?) FROM archive.xacts WHERE aid=2",[xid])
+    assert crs.fetchone()==(7,0)
+    assert list(debs.audit(crs))==["0 discrepancies\n"]
+
+def test_backup_and_export_keep_archive(app,tmp_path):
+    today=date.today().toordinal()
+    # an empty copy with the same accounts
+    fresh=str(tmp_path/"fresh.sql")
+    src=debs.connect(app.db,None)
+    dst=sqlite3.connect(fresh)
+    src.backup(dst)
+    src.close()
+    dst.close()
+    for i in range(4):
+        assert app.ins(2,1,today-40+i*10,dr=str(i+1))=="303 See Other"
+    assert close(app,today-25)==(0,"2 transactions archived\n")
+    page=app.req("/acct","aid=2")[2]
+    # the whole history, without the opening balances, imports anew
+    out=str(tmp_path/"out.csv")
+    bak=str(tmp_path/"bak.sql")
+    for db,args in ((app.db,["export",out]),(fresh,["import",out]),(app.db,["backup",bak])):
+        assert run(db,*args)[0]==0
+    crs=app.cursor()
+    debs.attach_archive(crs.connection,app.db)
+    crs.execute("SELECT * FROM archive.xacts UNION ALL SELECT * FROM xacts WHERE aid!=oaid ORDER BY xid,aid")
+    ledger=crs.fetchall()
+    crs=debs.connect(fresh,None).cursor()
+    crs.execute("SELECT * FROM xacts ORDER BY xid,aid")
+    assert len(ledger)==8 and crs.fetchall()==ledger
+    # a backup restored elsewhere brings its archive along
+    assert os.path.exists(bak+debs.ARCHIVE_SUFFIX)
+    restored=str(tmp_path/"restored.sql")
+    shutil.copy(os.path.join(os.path.dirname(debs.__file__),"debs.sql"),restored)
+    assert run(restored,"restore",bak)[0]==0
+    assert os.path.exists(restored+debs.ARCHIVE_SUFFIX)
+    os.environ["DB"]=restored
+    try:
+        assert app.req("/acct","aid=2")[2]==page
+    finally:
+        os.environ["DB"]=app.db
+        debs.pool_evict(restored)
@@ -0,0 +1,21 @@
+"""
+Concurrency: reads do not wait for a writer
+"""
+
+import sqlite3
+import time
+
+import debs
+
+def test_read_on_new_connection_while_writer_holds_lock(app):
+    debs.pool_evict(app.db)
+    writer=sqlite3.connect(app.db,isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        t=time.perf_counter()
+        status,_,_=app.req("/")
+        assert status=="200 OK"
+        assert time.perf_counter()-t<debs.BUSY_TIMEOUT
+    finally:
+        writer.rollback()
+        writer.close()
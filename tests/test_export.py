@@ -0,0 +1,62 @@
+"""
+Exports imported into an empty ledger give the same transactions
+"""
+
+import sqlite3
+import subprocess
+import sys
+from datetime import date
+
+import pytest
+
+import debs
+
+@pytest.mark.parametrize("ext",["csv","ndjson","col"])
+def test_round_trip(app,tmp_path,ext):
+    # an empty copy with the same accounts
+    fresh=str(tmp_path/"fresh.sql")
+    src=debs.connect(app.db,None)
+    dst=sqlite3.connect(fresh)
+    src.backup(dst)
+    src.close()
+    dst.close()
+    today=date.today().toordinal()
+    for i in range(30):
+        assert app.ins(2+i%3,1,today-300+i*10,dr="{},{:02}".format(i+1,i),comment="c{}%26%3C".format(i))=="303 See Other"
+    # an amount beyond 64 bits, which only the text formats hold
+    if ext!="col":
+        assert app.ins(3,1,today-5,dr="9"*25)=="303 See Other"
+    # zero amounts: the balance left as it is
+    bal=debs.balance(app.cursor(),2)
+    assert app.ins(2,4,today,newbal="{}.{:02}".format(bal//100,bal%100))=="303 See Other"
+    out=str(tmp_path/("out."+ext))
+    def run(db,*args):
+        debs.pool_evict(db)
+        r=subprocess.run([sys.executable,debs.__file__,"--db",db]+list(args),capture_output=True,text=True)
+        assert r.returncode==0,r.stderr
+        return r.stdout
+    run(app.db,"export",out)
+    run(fresh,"import",out)
+    rows=[]
+    for db in (app.db,fresh):
+        crs=debs.connect(db,None).cursor()
+        crs.execute("SELECT * FROM xacts ORDER BY xid,aid")
+        rows.append(crs.fetchall())
+        crs.connection.close()
+    assert len(rows[0])==(62 if ext=="col" else 64)
+    assert rows[0]==rows[1]
+
+def test_columns_refuse_wide_amounts(app,tmp_path):
+    today=date.today().toordinal()
+    assert app.ins(2,1,today,dr="1")=="303 See Other"
+    assert app.ins(3,1,today,dr="9"*25)=="303 See Other"
+    for qs in ("fmt=columns","fmt=columns&aid=3"):
+        status,_,body=app.req("/export",qs)
+        assert status=="400 Bad Request" and b"64 bits" in body
+    assert app.req("/export","fmt=columns&aid=2")[0]=="200 OK"
+    assert app.req("/export","fmt=csv")[0]=="200 OK"
+    out=tmp_path/"out.col"
+    debs.pool_evict(app.db)
+    r=subprocess.run([sys.executable,debs.__file__,"--db",app.db,"export",str(out)],capture_output=True,text=True)
+    assert r.returncode==2 and "64 bits" in r.stderr
+    assert not out.exists()
@@ -0,0 +1,78 @@
+"""
+Account pages: arguments out of range
+"""
+
+import io
+import random
+import re
+import sys
+from datetime import date
+
+import debs
+
+def test_out_of_range_cursor(app):
+    today=date.today().toordinal()
+    for i in range(3):
+        assert app.ins(2,1,today,dr=str(i+1))=="303 See Other"
+    first=app.req("/acct","aid=2")
+    for qs in ("aid=2&before_xid=99999999999999999999","aid=2&page=99999999999999999999",
+    "aid=2&page=92233720368547758","aid=2&before_xid=-99999999999999999999"):
+        status,_,body=app.req("/acct",qs)
+        assert status=="200 OK",qs
+        assert body==first[2],qs
+
+def test_cached_statement_is_streamed(app):
+    today=date.today().toordinal()
+    for i in range(3):
+        assert app.ins(2,1,today,dr=str(i+1))=="303 See Other"
+    environ={"PATH_INFO":"/acct","QUERY_STRING":"aid=2","wsgi.input":io.BytesIO(),"wsgi.errors":sys.stderr}
+    body=debs.application(environ,lambda s,h: None)
+    assert not isinstance(body,list)
+    body=b"".join(body)
+    hits=debs.PAGE_STATS["hits"]
+    assert app.req("/acct","aid=2")[2]==body
+    assert debs.PAGE_STATS["hits"]==hits+1
+
+def test_streamed_timing(app,monkeypatch):
+    monkeypatch.setattr(debs,"INSTRUMENT",True)
+    assert app.ins(2,1,date.today().toordinal(),dr="1")=="303 See Other"
+    timing=dict(app.req("/acct","aid=2")[1])["Server-Timing"]
+    assert timing.endswith('desc="before the body"') and "db;" not in timing
+    timing=dict(app.req("/trial_bal")[1])["Server-Timing"]
+    assert "db;dur=" in timing
+
+def lookup_rows(crs,aid,before,limit):
+    """statement rows read alone, with each opposing account looked up on its own"""
+    crs.execute("""SELECT xid,dt,aid,oaid,dr,cr,bal,comment FROM xacts
+    WHERE aid=? AND (dt,xid)<(?,?) ORDER BY dt DESC,xid DESC LIMIT ?""",
+    [aid]+list(before or (2**63-1,2**63-1))+[limit])
+    rows=[]
+    for row in crs.fetchall():
+        crs.execute("SELECT type,name,cdt FROM accts WHERE aid=?",[row[3]])
+        rows.append(row+crs.fetchone())
+    return rows
+
+def test_statement_rows_match_per_row_lookups(app):
+    rnd=random.Random(4)
+    today=date.today().toordinal()
+    for i in range(450):
+        aid,oaid=rnd.sample(range(1,7),2)
+        assert app.ins(aid,oaid,today-rnd.randrange(900),dr="{},{:02}".format(rnd.randrange(1,10**5),i%100),
+        comment="c{}".format(i))=="303 See Other"
+    # an account closed at a zero balance
+    assert app.req("/creat_acct",post="atype=A&aname=Old")[0].startswith("303")
+    assert app.ins(7,2,today,dr="5")=="303 See Other"
+    assert app.ins(7,2,today,cr="5")=="303 See Other"
+    assert app.req("/close_acct",post="aid=7")[0].startswith("303")
+    crs=app.cursor()
+    pages=0
+    for aid in range(1,8):
+        before=None
+        while True:
+            rows=debs.statement_rows(crs,aid,before,debs.LIMIT+1)
+            assert rows==lookup_rows(crs,aid,before,debs.LIMIT+1)
+            pages+=1
+            if len(rows)<=debs.LIMIT:
+                break
+            before=rows[debs.LIMIT-1][1::-1]
+    assert pages>8
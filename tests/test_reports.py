@@ -0,0 +1,29 @@
+"""
+Reports: the date forms
+"""
+
+from datetime import date
+
+def test_trial_balance_date(app):
+    today=date.today().toordinal()
+    assert app.ins(2,1,today-10,dr="1")=="303 See Other"
+    assert app.ins(2,1,today,dr="2")=="303 See Other"
+    page=app.req("/trial_bal")[2]
+    assert 'value="{}"'.format(date.fromordinal(today)).encode() in page
+    status,_,body=app.submit(page,dt=date.fromordinal(today-5).isoformat())
+    assert status=="200 OK"
+    assert 'value="{}"'.format(date.fromordinal(today-5)).encode() in body
+    assert b"1,00" in body and b"3,00" not in body
+    assert b"3,00" in page
+
+def test_income_statement_range(app):
+    today=date.today().toordinal()
+    assert app.ins(4,2,today-10,dr="7")=="303 See Other"
+    assert app.ins(4,2,today,dr="9")=="303 See Other"
+    page=app.req("/income_stmt","from={}".format(date.fromordinal(today-20)))[2]
+    assert b"16,00" in page
+    d=date.fromordinal(today-5).isoformat()
+    status,_,body=app.submit(page,**{"from":d})
+    assert status=="200 OK"
+    assert 'name=from size=10 maxlength=10 class=w12 value="{}"'.format(d).encode() in body
+    assert b"9,00" in body and b"16,00" not in body
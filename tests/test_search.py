@@ -0,0 +1,36 @@
+"""
+Search: comments are matched as typed
+"""
+
+from datetime import date
+from urllib.parse import urlencode
+
+def test_escaped_characters(app):
+    today=date.today().toordinal()
+    for comment in ("Smith's rent","bread & butter",'<b>bold</b> "quoted"',"plain amp"):
+        assert app.ins(2,1,today,dr="1",comment=urlencode({"c":comment})[2:])=="303 See Other"
+    def found(q):
+        status,_,body=app.req("/search",urlencode({"q":q,"fmt":"json"}))
+        assert status=="200 OK"
+        return body.count(b"\n")
+    assert found("Smith's")==1
+    assert found("&")==0 # punctuation alone is no word
+    assert found("bread & butter")==1
+    assert found("amp")==1
+    assert found("quoted")==1
+    assert found("<b>bold</b>")==1
+
+def test_out_of_range_arguments(app):
+    assert app.req("/search","q=x&before_xid=99999999999999999999")[0]=="400 Bad Request"
+    assert app.req("/search","q=x&aid=99999999999999999999")[0]=="400 Bad Request"
+
+def test_date_range_form(app):
+    today=date.today().toordinal()
+    for dt in (today-30,today-20,today-10):
+        assert app.ins(2,1,dt,dr="1",comment="rent")=="303 See Other"
+    page=app.req("/search","q=rent")[2]
+    assert page.count(b"<td class=date>")==3
+    status,_,body=app.submit(page,**{"from":date.fromordinal(today-25).isoformat(),
+    "to":date.fromordinal(today-15).isoformat()})
+    assert status=="200 OK"
+    assert body.count(b"<td class=date>")==1